@@ -90,7 +90,7 @@ echo ""
 
 # Copy updated exporters (in case this is an update, not fresh install)
 echo "Updating exporters..."
-ssh "${REMOTE_USER}@${REMOTE_HOST}" "$SUDO cp $REMOTE_TEMP/exporters/*.py $REMOTE_TEMP/exporters/*.sh $INSTALL_DIR/exporters/ 2>/dev/null || true"
+ssh "${REMOTE_USER}@${REMOTE_HOST}" "$SUDO cp $REMOTE_TEMP/exporters/*.py $REMOTE_TEMP/exporters/*.sh $REMOTE_TEMP/exporters/*.json $INSTALL_DIR/exporters/ 2>/dev/null || true"
 ssh "${REMOTE_USER}@${REMOTE_HOST}" "$SUDO chmod +x $INSTALL_DIR/exporters/*.py $INSTALL_DIR/exporters/*.sh"
 echo "✓ Exporters updated"
 echo ""
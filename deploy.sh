@@ -45,9 +45,20 @@ fi
 # Copy all exporter files
 echo "  - Copying exporters..."
 cp "$TEMP_DIR/exporters/platform-detect.sh" "$INSTALL_DIR/exporters/"
+cp "$TEMP_DIR/exporters/platform_detect.py" "$INSTALL_DIR/exporters/"
+cp "$TEMP_DIR/exporters/vhost_config.py" "$INSTALL_DIR/exporters/"
 cp "$TEMP_DIR/exporters/site-metrics.py" "$INSTALL_DIR/exporters/"
 cp "$TEMP_DIR/exporters/user-metrics.sh" "$INSTALL_DIR/exporters/"
+cp "$TEMP_DIR/exporters/swap-metrics.sh" "$INSTALL_DIR/exporters/"
+cp "$TEMP_DIR/exporters/metrics-server.py" "$INSTALL_DIR/exporters/"
+cp "$TEMP_DIR/exporters/metrics_registry.py" "$INSTALL_DIR/exporters/"
+cp "$TEMP_DIR/exporters/exporter_stats.py" "$INSTALL_DIR/exporters/"
+cp "$TEMP_DIR/exporters/sampling_profiler.py" "$INSTALL_DIR/exporters/"
+cp "$TEMP_DIR/exporters/error_logs.py" "$INSTALL_DIR/exporters/"
+cp "$TEMP_DIR/exporters/rollup_store.py" "$INSTALL_DIR/exporters/"
+cp "$TEMP_DIR/exporters/baselines.py" "$INSTALL_DIR/exporters/"
 cp "$TEMP_DIR/exporters/log-analyzer.py" "$INSTALL_DIR/exporters/"
+cp "$TEMP_DIR/exporters/ua-rules.json" "$INSTALL_DIR/exporters/"
 
 # Copy test scripts
 echo "  - Copying test scripts..."
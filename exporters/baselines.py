@@ -0,0 +1,175 @@
+"""
+Square Candy Site Baselines
+Streaming per-site baselines for the log analyzer. Each collection feeds the
+recent requests per minute, 5xx ratio and bytes per minute of every site into
+exponentially weighted means and variances: one all-day baseline plus one per
+hour of the day, so a site that is always busy at 09:00 is compared with
+other 09:00s. The result is an anomaly score (deviation from the baseline in
+standard deviations) that alerts can threshold directly.
+
+Memory is constant per site. The state is saved to a file now and then so a
+restart does not start the learning over.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+from array import array
+from typing import Dict, Optional, Tuple
+
+STATE_FILE = os.environ.get('SQCDY_BASELINE_STATE', '/var/cache/squarecandy-monitoring/site-baselines.json')
+STATE_VERSION = 1
+SAVE_INTERVAL = 900
+
+# Observed values, in this order
+METRICS = ('requests', 'error_ratio', 'bytes')
+# Minutes of traffic each observation covers
+RECENT_MINUTES = 5
+
+# Time constants: the all-day baseline follows the last few hours, an hourly
+# bucket the last few days (it only learns during its own hour)
+DAY_TAU = 6 * 3600
+HOUR_TAU = 3 * 3600
+# Longest gap between observations that still counts as elapsed time
+MAX_STEP = 300
+# Observations needed before a baseline is trusted
+MIN_DAY_OBSERVATIONS = 15
+MIN_HOUR_OBSERVATIONS = 30
+# Pseudo-requests at the baseline 5xx ratio added to each observation, so one
+# failed request on a quiet site does not read as a 100% error rate
+ERROR_RATIO_PRIOR = 20
+# Sites not seen for this long are forgotten
+FORGET_AFTER = 14 * 86400
+
+BUCKETS = 25  # 24 hours of the day, then the all-day baseline
+DAY_BUCKET = 24
+
+
+def std_floor(metric: int, mean: float) -> float:
+    """Smallest standard deviation assumed for a metric, so quiet sites do not score on noise"""
+    if metric == 0:
+        # Poisson noise of a rate averaged over RECENT_MINUTES
+        return math.sqrt(max(mean, 1.0) / RECENT_MINUTES)
+    if metric == 1:
+        return 0.02
+    return max(0.1 * mean, 1024.0)
+
+
+class SiteBaseline:
+    """EWMA mean and variance of each metric for every hour bucket of one site"""
+
+    __slots__ = ('stats', 'counts', 'last_update')
+
+    def __init__(self):
+        # [bucket][metric] -> (mean, variance), flattened
+        self.stats = array('d', bytes(8 * BUCKETS * len(METRICS) * 2))
+        self.counts = array('I', bytes(4 * BUCKETS))
+        self.last_update = 0.0
+
+    def score(self, bucket: int, metric: int, value: float, requests: float) -> Optional[float]:
+        """Deviation of value from the hour bucket, or the all-day baseline while the bucket is young"""
+        if self.counts[bucket] < MIN_HOUR_OBSERVATIONS:
+            bucket = DAY_BUCKET
+            if self.counts[bucket] < MIN_DAY_OBSERVATIONS:
+                return None
+        i = (bucket * len(METRICS) + metric) * 2
+        mean, variance = self.stats[i], self.stats[i + 1]
+        if metric == 1:
+            value = (value * requests + mean * ERROR_RATIO_PRIOR) / (requests + ERROR_RATIO_PRIOR)
+        return (value - mean) / max(math.sqrt(variance), std_floor(metric, mean))
+
+    def update(self, bucket: int, values: Tuple[float, ...], now: float):
+        step = min(now - self.last_update, MAX_STEP) if self.last_update else MAX_STEP
+        self.last_update = now
+        for b, tau in ((bucket, HOUR_TAU), (DAY_BUCKET, DAY_TAU)):
+            self.counts[b] += 1
+            # Plain averaging until the EWMA weight takes over, so early values are not biased to 0
+            alpha = max(1 - math.exp(-step / tau), 1 / self.counts[b])
+            for metric, value in enumerate(values):
+                i = (b * len(METRICS) + metric) * 2
+                diff = value - self.stats[i]
+                increment = alpha * diff
+                self.stats[i] += increment
+                self.stats[i + 1] = (1 - alpha) * (self.stats[i + 1] + diff * increment)
+
+    def mean(self, bucket: int, metric: int) -> Optional[float]:
+        if self.counts[bucket] < MIN_HOUR_OBSERVATIONS:
+            bucket = DAY_BUCKET
+            if self.counts[bucket] < MIN_DAY_OBSERVATIONS:
+                return None
+        return self.stats[(bucket * len(METRICS) + metric) * 2]
+
+
+class SiteBaselines:
+    """Baselines of all sites, with optional persistence"""
+
+    def __init__(self, state_file: Optional[str] = STATE_FILE):
+        self.state_file = state_file
+        self.sites: Dict[str, SiteBaseline] = {}
+        self.last_save = time.time()
+        if state_file:
+            self.load()
+
+    def observe(self, domain: str, values: Tuple[float, ...], now: Optional[float] = None) -> Dict[str, Optional[float]]:
+        """Score the values against the site's baseline, then learn from them
+
+        Returns {'<metric>_score': score or None, 'requests_baseline': mean or None}.
+        """
+        now = now or time.time()
+        bucket = time.localtime(now).tm_hour
+        site = self.sites.get(domain)
+        if site is None:
+            site = self.sites[domain] = SiteBaseline()
+        # Score first so a spike is judged before it moves the baseline
+        requests = values[0] * RECENT_MINUTES
+        result = {f'{name}_score': site.score(bucket, metric, values[metric], requests)
+                  for metric, name in enumerate(METRICS)}
+        result['requests_baseline'] = site.mean(bucket, 0)
+        site.update(bucket, values, now)
+        return result
+
+    def maintain(self, now: Optional[float] = None):
+        """Forget sites that went away and save the state every SAVE_INTERVAL"""
+        now = now or time.time()
+        self.sites = {domain: site for domain, site in self.sites.items() if now - site.last_update < FORGET_AFTER}
+        if self.state_file and now - self.last_save >= SAVE_INTERVAL:
+            self.last_save = now
+            self.save()
+
+    def save(self):
+        state = {
+            'version': STATE_VERSION,
+            'sites': {domain: {'stats': site.stats.tolist(), 'counts': site.counts.tolist(),
+                               'last_update': site.last_update}
+                      for domain, site in self.sites.items()},
+        }
+        try:
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            tmp_path = f'{self.state_file}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f, separators=(',', ':'))
+            os.replace(tmp_path, self.state_file)
+        except OSError as e:
+            print(f"Could not save site baselines to {self.state_file}: {e}", file=sys.stderr)
+
+    def load(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Could not load site baselines from {self.state_file}: {e}", file=sys.stderr)
+            return
+        if state.get('version') != STATE_VERSION:
+            return
+        for domain, saved in state.get('sites', {}).items():
+            site = SiteBaseline()
+            if len(saved.get('stats', ())) != len(site.stats) or len(saved.get('counts', ())) != len(site.counts):
+                continue
+            site.stats = array('d', saved['stats'])
+            site.counts = array('I', saved['counts'])
+            site.last_update = saved.get('last_update', 0.0)
+            self.sites[domain] = site
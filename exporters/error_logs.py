@@ -0,0 +1,225 @@
+"""
+Square Candy Error Log Analysis
+Incremental parsing of web server error logs and PHP-FPM slowlogs for the
+log analyzer. Files are tailed from the offset reached on the previous
+collection (tracking inode changes for rotation), so each collection costs
+only what was appended since. Counts are cumulative for the life of the
+process and exported as counters.
+"""
+
+import os
+import re
+import glob
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+# Upper bound on bytes read from one file per collection; the rest is read next time
+MAX_TAIL_BYTES = 32 * 1024 * 1024
+
+# nginx: 2026/10/19 12:00:00 [error] 123#123: ...
+NGINX_SEVERITY = re.compile(r'^\d{4}/\d\d/\d\d \d\d:\d\d:\d\d \[(\w+)\]')
+# Apache 2.4: [Mon Oct 19 12:00:00.123456 2026] [proxy_fcgi:error] [pid 123] ...
+APACHE_SEVERITY = re.compile(r'^\[[^\]]+\] \[(?:[\w-]*:)?(\w+)\]')
+# PHP error_log: [19-Oct-2026 12:00:00 UTC] PHP Fatal error:  ...
+PHP_SEVERITY = re.compile(r'PHP (Fatal error|Parse error|Warning|Notice|Deprecated)')
+
+SEVERITIES = {
+    'warning': 'warn', 'fatal error': 'error', 'parse error': 'error', 'deprecated': 'notice',
+    'debug': 'debug', 'info': 'info', 'notice': 'notice', 'warn': 'warn', 'error': 'error',
+    'crit': 'crit', 'alert': 'alert', 'emerg': 'emerg',
+}
+
+# Error classes, first match wins; anything else is "other"
+ERROR_CLASSES = [
+    ('upstream_timeout', re.compile(r'upstream timed out|Connection timed out\) while', re.I)),
+    ('upstream_closed', re.compile(r'upstream prematurely closed', re.I)),
+    ('upstream_unavailable', re.compile(r'no live upstreams|connect\(\) (?:to \S+ )?failed|Connection refused', re.I)),
+    ('too_many_open_files', re.compile(r'Too many open files', re.I)),
+    ('php_memory_exhausted', re.compile(r'Allowed memory size of \d+ bytes exhausted', re.I)),
+    ('php_timeout', re.compile(r'Maximum execution time of \d+ seconds? exceeded|request_terminate_timeout|execution timed out', re.I)),
+    ('php_fatal', re.compile(r'PHP (?:Fatal|Parse) error', re.I)),
+    ('php_warning', re.compile(r'PHP (?:Warning|Notice|Deprecated)', re.I)),
+    ('rate_limited', re.compile(r'limiting (?:requests|connections)', re.I)),
+    ('body_too_large', re.compile(r'client intended to send too large body', re.I)),
+    ('permission_denied', re.compile(r'Permission denied|AH01630|AH01797', re.I)),
+    ('not_found', re.compile(r'No such file or directory|is not found|AH01276|File does not exist', re.I)),
+    ('ssl', re.compile(r'SSL_do_handshake|SSL_read|SSL_write|ssl_client', re.I)),
+]
+
+# PHP-FPM slowlog entries:
+#   [19-Oct-2026 12:00:00]  [pool example.com] pid 1234
+#   script_filename = /var/www/example.com/htdocs/index.php
+#   [0x00007f...] curl_exec() /var/www/example.com/htdocs/wp-includes/class-wp-http-curl.php:303
+SLOWLOG_HEADER = re.compile(r'^\[[^\]]+\]\s+\[pool ([^\]]+)\]\s+pid\s+\d+')
+SLOWLOG_SCRIPT = re.compile(r'^script_filename = (.*)$')
+SLOWLOG_FRAME = re.compile(r'^\[0x[0-9a-fA-F]+\]\s+(.+?)\s+(\S+):\d+$')
+
+# PHP-FPM pool configs that may define a slowlog
+FPM_POOL_CONFIGS = (
+    '/etc/php/*/fpm/pool.d/*.conf',
+    '/opt/plesk/php/*/etc/php-fpm.d/*.conf',
+    '/etc/php-fpm.d/*.conf',
+)
+
+# Path components kept when labelling a slow frame's file
+FRAME_PATH_DEPTH = 3
+
+
+class LogTail:
+    """Returns the complete lines appended to files since the previous call
+
+    Files present on the first call start at their end, so a restart does
+    not count old history; files that appear later are read from the start.
+    """
+
+    def __init__(self, max_bytes: int = MAX_TAIL_BYTES):
+        self.max_bytes = max_bytes
+        # path -> (inode, offset)
+        self.positions: Dict[str, Tuple[int, int]] = {}
+        self.primed = False
+        self.bytes_read = 0
+
+    def read_new(self, paths: Iterable[str]) -> Iterable[Tuple[str, List[str]]]:
+        """Yield (path, new lines) for each path with appended data"""
+        positions = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            inode, offset = self.positions.get(path, (st.st_ino, 0 if self.primed else st.st_size))
+            if inode != st.st_ino or st.st_size < offset:
+                # Rotated or truncated: start over on the new file
+                inode, offset = st.st_ino, 0
+            positions[path] = (inode, offset)
+            if st.st_size == offset:
+                continue
+
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(min(st.st_size - offset, self.max_bytes))
+            except OSError:
+                continue
+            end = data.rfind(b'\n') + 1
+            if end == 0 and len(data) < self.max_bytes:
+                # Only a partial line so far
+                continue
+            if end == 0:
+                end = len(data)
+            positions[path] = (inode, offset + end)
+            self.bytes_read += end
+            yield path, data[:end].decode('utf-8', 'replace').splitlines()
+
+        self.positions = positions
+        self.primed = True
+
+
+def classify_error(line: str) -> Tuple[str, str]:
+    """(severity, class) of an error log line"""
+    match = NGINX_SEVERITY.match(line) or APACHE_SEVERITY.match(line)
+    severity = match.group(1).lower() if match else None
+    if severity is None:
+        match = PHP_SEVERITY.search(line)
+        severity = match.group(1).lower() if match else 'unknown'
+    severity = SEVERITIES.get(severity, 'unknown')
+
+    for name, pattern in ERROR_CLASSES:
+        if pattern.search(line):
+            return severity, name
+    return severity, 'other'
+
+
+class ErrorLogAnalyzer:
+    """Cumulative error counts per domain, severity and class"""
+
+    def __init__(self):
+        self.tail = LogTail()
+        # (domain, severity, class) -> lines
+        self.counts: Counter = Counter()
+
+    def update(self, log_files: Dict[str, List[str]]):
+        domains = {path: domain for domain, paths in log_files.items() for path in paths}
+        for path, lines in self.tail.read_new(domains):
+            domain = domains[path]
+            counts = self.counts
+            for line in lines:
+                if line:
+                    counts[(domain,) + classify_error(line)] += 1
+
+
+def find_slowlogs() -> List[str]:
+    """Slowlog paths declared by the local PHP-FPM pools"""
+    paths = set()
+    for pattern in FPM_POOL_CONFIGS:
+        for config in glob.glob(pattern):
+            pool = None
+            try:
+                with open(config, errors='replace') as f:
+                    for line in f:
+                        line = line.strip()
+                        if line.startswith('[') and line.endswith(']'):
+                            pool = line[1:-1]
+                        elif line.startswith('slowlog') and '=' in line:
+                            path = line.split('=', 1)[1].strip().strip('"\'')
+                            if pool:
+                                path = path.replace('$pool', pool)
+                            if '$' not in path:
+                                paths.add(path)
+            except OSError:
+                continue
+    return sorted(paths)
+
+
+def short_frame_path(path: str) -> str:
+    """Last few components of a file path, enough to identify it within a site"""
+    return '/'.join(path.split('/')[-FRAME_PATH_DEPTH:])
+
+
+class SlowlogAnalyzer:
+    """Cumulative PHP-FPM slow request counts per domain and top stack frame"""
+
+    def __init__(self):
+        self.tail = LogTail()
+        self.requests: Counter = Counter()
+        # domain -> Counter of (function, file)
+        self.frames: Dict[str, Counter] = {}
+        # Parse state per file, since an entry can span two collections:
+        # path -> [pool, domain from script path, waiting for the top frame]
+        self.state: Dict[str, list] = {}
+
+    def update(self, paths: List[str], domains: Iterable[str]):
+        # Longest first so sub.example.com wins over example.com
+        known = sorted(set(domains), key=len, reverse=True)
+        for path, lines in self.tail.read_new(paths):
+            state = self.state.setdefault(path, [None, None, False])
+            for line in lines:
+                self._parse_line(line.strip(), state, known)
+
+    def _parse_line(self, line: str, state: list, known: List[str]):
+        match = SLOWLOG_HEADER.match(line)
+        if match:
+            state[:] = [match.group(1), None, True]
+            return
+        if not state[2]:
+            return
+        match = SLOWLOG_SCRIPT.match(line)
+        if match:
+            script = match.group(1)
+            state[1] = next((d for d in known if f'/{d}/' in script), None)
+            return
+        match = SLOWLOG_FRAME.match(line)
+        if match:
+            domain = self._domain(state, known)
+            self.requests[domain] += 1
+            self.frames.setdefault(domain, Counter())[(match.group(1), short_frame_path(match.group(2)))] += 1
+            state[2] = False
+
+    @staticmethod
+    def _domain(state: list, known: List[str]) -> str:
+        # A site directory in the script path wins; otherwise fall back to the
+        # pool name, which GridPane and Plesk set to the site's domain. Other
+        # pool names (e.g. Debian's default "www") are not sites
+        if state[1]:
+            return state[1]
+        return state[0] if state[0] in known else 'unknown'
@@ -0,0 +1,127 @@
+"""
+Square Candy Exporter Self-Instrumentation
+Shared by the exporters to report their own cost: collection duration
+histogram, per-phase timings, work counters, last success time and RSS
+"""
+
+import os
+import time
+import resource
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+from metrics_registry import MetricRegistry
+
+# Collection duration histogram buckets in seconds
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def process_rss_bytes() -> int:
+    """Current resident set size of this process"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        # Peak RSS (kilobytes on Linux) is the best we can do without /proc
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ExporterStats:
+    """Collection timings and work counters for one exporter
+
+    Counters accumulate for the life of the process; gauges and phase
+    timings describe the most recent collection and are reset by
+    start_collection().
+    """
+
+    def __init__(self, exporter: str, buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        self.exporter = exporter
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.duration_sum = 0.0
+        self.duration_count = 0
+        self.errors = 0
+        self.last_success = 0.0
+        self.phases: Dict[str, float] = {}
+        self.current_phases: Dict[str, float] = defaultdict(float)
+        # name -> (help, type, label names); values: name -> {label values: value}
+        self.families: Dict[str, Tuple[str, str, Tuple[str, ...]]] = {}
+        self.values: Dict[str, Dict[Tuple, float]] = {}
+
+    def describe(self, name: str, help_text: str, labels: Tuple[str, ...] = (), metric_type: str = 'counter'):
+        """Declare an exporter-specific counter or gauge"""
+        self.families[name] = (help_text, metric_type, labels)
+        self.values.setdefault(name, defaultdict(float))
+
+    def inc(self, name: str, amount: float = 1, *label_values):
+        self.values[name][label_values] += amount
+
+    def set(self, name: str, value: float, *label_values):
+        self.values[name][label_values] = value
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time a collection phase; repeated entries into a phase accumulate"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.current_phases[name] += time.perf_counter() - start
+
+    def start_collection(self):
+        self.current_phases = defaultdict(float)
+        for name, (_, metric_type, _) in self.families.items():
+            if metric_type == 'gauge':
+                self.values[name].clear()
+
+    def finish_collection(self, duration: float, success: bool = True):
+        self.duration_sum += duration
+        self.duration_count += 1
+        for i, bound in enumerate(self.buckets):
+            if duration <= bound:
+                self.bucket_counts[i] += 1
+        if success:
+            self.last_success = time.time()
+            self.phases = dict(self.current_phases)
+        else:
+            self.errors += 1
+
+    def add_to(self, registry: MetricRegistry) -> MetricRegistry:
+        """Add self-metrics to a registry, all labelled with the exporter name"""
+        exporter = self.exporter
+
+        family = registry.family('sqcdy_exporter_collection_duration_seconds',
+                                 'Time taken by a full metrics collection', 'histogram', ('exporter',))
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            family.add(count, exporter, suffix='_bucket', extra_labels=(('le', f'{bound:g}'),))
+        family.add(self.duration_count, exporter, suffix='_bucket', extra_labels=(('le', '+Inf'),))
+        family.add(round(self.duration_sum, 6), exporter, suffix='_sum')
+        family.add(self.duration_count, exporter, suffix='_count')
+
+        family = registry.family('sqcdy_exporter_phase_duration_seconds',
+                                 'Time spent in each phase of the last successful collection', 'gauge',
+                                 ('exporter', 'phase'))
+        for phase, seconds in sorted(self.phases.items()):
+            family.add(round(seconds, 6), exporter, phase)
+
+        registry.family('sqcdy_exporter_collection_errors_total', 'Collections that failed',
+                        'counter', ('exporter',)).add(self.errors, exporter)
+        registry.family('sqcdy_exporter_last_success_timestamp_seconds',
+                        'Unix time of the last successful collection', 'gauge',
+                        ('exporter',)).add(round(self.last_success, 3), exporter)
+        registry.family('sqcdy_exporter_resident_memory_bytes', 'Resident memory of the exporter process',
+                        'gauge', ('exporter',)).add(process_rss_bytes(), exporter)
+
+        for name, (help_text, metric_type, label_names) in self.families.items():
+            family = registry.family(name, help_text, metric_type, ('exporter',) + tuple(label_names))
+            for label_values, value in sorted(self.values[name].items()):
+                family.add(value, exporter, *label_values)
+
+        return registry
+
+    def render(self, openmetrics: bool = False) -> bytes:
+        """Render self-metrics on their own (for exporters without a registry)"""
+        return self.add_to(MetricRegistry()).render(openmetrics)
@@ -9,16 +9,34 @@ import os
 import sys
 import re
 import gzip
+import math
+import zlib
+import socket
+import ipaddress
+from array import array
+from bisect import bisect_right
 from collections import defaultdict, Counter
 from datetime import datetime, timedelta
 from pathlib import Path
 from http.server import HTTPServer, BaseHTTPRequestHandler, ThreadingHTTPServer
-import subprocess
 import json
 import argparse
+import csv
 from typing import Dict, List, Tuple, Optional
 import time
 import threading
+from functools import lru_cache
+from itertools import islice, repeat
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from exporter_stats import ExporterStats
+from platform_detect import get_platform_info
+from vhost_config import VhostConfig
+from error_logs import ErrorLogAnalyzer, LogTail, SlowlogAnalyzer, find_slowlogs
+from metrics_registry import MetricRegistry, CONTENT_TYPE_OPENMETRICS, CONTENT_TYPE_TEXT, wants_openmetrics
+from sampling_profiler import SamplingProfiler, handle_profile_request
+from rollup_store import RollupStore, DEFAULT_RETENTION_DAYS, handle_query_request, new_rollup
+from baselines import SiteBaselines, RECENT_MINUTES, STATE_FILE as BASELINE_STATE_FILE
 
 # Log parsing regex patterns
 NGINX_LOG_PATTERN = re.compile(
@@ -52,17 +70,645 @@ APACHE_LOG_PATTERN = re.compile(
     r'"(?P<method>\S+) (?P<url>\S+) \S+" (?P<status>\d+) (?P<size>\d+)'
 )
 
+# Lines read from a log file per batch (read/parse/aggregate are timed per batch)
+BATCH_LINES = 1000
+# Safety cap on lines read per file
+MAX_LINES_PER_FILE = 50000
+# Read the last 5MB of large files so we reach recent log entries efficiently
+TAIL_BYTES = 5 * 1024 * 1024
+
+# Line sampling for sites above the line budget (see LineSampler). Rates are
+# powers of two down to MIN_SAMPLE_RATE
+SAMPLE_SPACE = 1 << 16
+MIN_SAMPLE_RATE = 1 / 1024
+# Lines after which a client counts as heavy and is sampled line by line
+HEAVY_CLIENT_LINES = 100
+
+# URL path segments collapsed into placeholders: numeric IDs, hex hashes and UUIDs
+NUMERIC_SEGMENT = re.compile(r'^\d+$')
+HASH_SEGMENT = re.compile(
+    r'^(?:[0-9a-f]{16,}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})$', re.IGNORECASE
+)
+
+# Fallbacks for user agents no rule matches: self-declared crawlers, then the
+# leading product token of non-browser clients (e.g. "SomeTool/1.2")
+BOT_PATTERN = re.compile(r'([\w.-]*(?:bot|crawler|spider))\b', re.IGNORECASE)
+PRODUCT_PATTERN = re.compile(r'^([A-Za-z][\w.-]*)/')
+
+# Per-site families: name, help, type, labels after (instance, domain)
+SITE_FAMILIES = [
+    ('sqcdy_site_requests_total', 'Total HTTP requests in time window', 'counter', ()),
+    ('sqcdy_site_traffic_bytes', 'Total traffic in bytes in time window', 'counter', ()),
+    ('sqcdy_site_requests_per_minute', 'Requests per minute', 'gauge', ()),
+    ('sqcdy_site_bytes_per_minute', 'Bytes per minute', 'gauge', ()),
+    ('sqcdy_site_window_requests', 'HTTP requests in the analysis window', 'gauge', ()),
+    ('sqcdy_site_window_traffic_bytes', 'Traffic in bytes in the analysis window', 'gauge', ()),
+    ('sqcdy_site_window_status_code_requests', 'Requests by status code in the analysis window', 'gauge', ('status',)),
+    ('sqcdy_site_request_anomaly_score', 'Recent requests per minute vs the site baseline for this hour, in standard deviations', 'gauge', ()),
+    ('sqcdy_site_error_ratio_anomaly_score', 'Recent 5xx ratio vs the site baseline for this hour, in standard deviations', 'gauge', ()),
+    ('sqcdy_site_bytes_anomaly_score', 'Recent bytes per minute vs the site baseline for this hour, in standard deviations', 'gauge', ()),
+    ('sqcdy_site_request_baseline_per_minute', 'Baseline requests per minute of the site for this hour', 'gauge', ()),
+    ('sqcdy_site_sampling_rate', 'Share of clients whose log lines were analyzed (1 when the site is below the line budget)', 'gauge', ()),
+    ('sqcdy_site_sampling_error_ratio', 'Relative error bound (95%) of the sampled request estimate, 0 when not sampled', 'gauge', ()),
+    ('sqcdy_site_top_ip_requests', 'Requests from top IP addresses', 'counter', ('ip',)),
+    ('sqcdy_site_top_prefix_requests', 'Requests from the top client network prefixes', 'gauge', ('prefix', 'asn', 'provider')),
+    ('sqcdy_site_top_prefix_addresses', 'Distinct client addresses seen in each top network prefix', 'gauge', ('prefix', 'asn', 'provider')),
+    ('sqcdy_site_top_user_agent_requests', 'Requests from top user agents', 'counter', ('user_agent',)),
+    ('sqcdy_site_top_url_requests', 'Requests to top URLs', 'counter', ('url',)),
+    ('sqcdy_site_status_code_total', 'Requests by status code', 'counter', ('status',)),
+    ('sqcdy_site_requests_by_agent_class', 'Requests by user agent category and family', 'gauge', ('category', 'family')),
+    ('sqcdy_site_error_log_lines_total', 'Error log lines by severity and class since the exporter started', 'counter', ('severity', 'class')),
+    ('sqcdy_site_php_slow_requests_total', 'PHP-FPM slowlog entries since the exporter started', 'counter', ()),
+    ('sqcdy_site_php_slow_frames_total', 'PHP-FPM slowlog entries by top stack frame', 'counter', ('function', 'file')),
+]
+
+# Help of the families that become true counters with --counter-mode cumulative
+CUMULATIVE_HELP = {
+    'sqcdy_site_requests_total': 'HTTP requests since the exporter started',
+    'sqcdy_site_traffic_bytes': 'Traffic in bytes since the exporter started',
+    'sqcdy_site_status_code_total': 'Requests by status code since the exporter started',
+}
+COUNTER_MODES = ('window', 'cumulative')
+
+# Current log file names per platform, for access and error logs
+LOG_KINDS = {
+    'access': {
+        'plesk': ['access_ssl_log', 'proxy_access_ssl_log', 'access_log', 'proxy_access_log'],
+        'gridpane': '.access.log',
+        'ubuntu': '*access*.log',
+        'vhost': 'access_logs',
+    },
+    'error': {
+        'plesk': ['error_log', 'proxy_error_log'],
+        'gridpane': '.error.log',
+        'ubuntu': '*error*.log',
+        'vhost': 'error_logs',
+    },
+}
+
+# Parsed nginx/Apache vhosts, re-read only when a config file changes
+VHOST_CONFIG = VhostConfig()
+
+# Default user agent classification rules, shipped next to this script
+UA_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ua-rules.json')
+
+# Memoization sizes for per-line normalization (URLs and UAs repeat heavily)
+NORMALIZE_CACHE_SIZE = 65536
+
+
+class UrlNormalizer:
+    """Maps raw request URLs onto a stable set of label values
+
+    Query strings are dropped except for whitelisted parameters, and numeric
+    or hash-like path segments become :id / :hash so /post/123 and /post/456
+    share one series.
+    """
+
+    def __init__(self, keep_params: Tuple[str, ...] = (), collapse_segments: bool = True, max_length: int = 200):
+        self.keep_params = frozenset(keep_params)
+        self.collapse_segments = collapse_segments
+        self.max_length = max_length
+        self.normalize = lru_cache(maxsize=NORMALIZE_CACHE_SIZE)(self._normalize)
+
+    def _normalize(self, url: str) -> str:
+        path, _, query = url.partition('?')
+        if self.collapse_segments:
+            segments = path.split('/')
+            for i, segment in enumerate(segments):
+                if NUMERIC_SEGMENT.match(segment):
+                    segments[i] = ':id'
+                elif HASH_SEGMENT.match(segment):
+                    segments[i] = ':hash'
+            path = '/'.join(segments)
+        if self.keep_params and query:
+            kept = sorted(p for p in query.split('&') if p.split('=', 1)[0] in self.keep_params)
+            if kept:
+                path = path + '?' + '&'.join(kept)
+        return path[:self.max_length]
+
+
+def load_user_agent_rules(path: str) -> List[Dict[str, str]]:
+    """Load classification rules: [{"family", "category", "match" | "regex"}, ...]"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error loading user agent rules from {path}: {e}", file=sys.stderr)
+        return []
+
+
+class UserAgentClassifier:
+    """Maps user agent strings to a (family, category) pair
+
+    Rules are tried in file order. They are compiled into a single regex of
+    `.*?(rule)` alternatives, so one match call finds the first rule that
+    applies, and results are memoized in a bounded LRU since the same user
+    agents repeat on nearly every line.
+    """
+
+    def __init__(self, rules: List[Dict[str, str]], cache_size: int = NORMALIZE_CACHE_SIZE):
+        branches = []
+        # Capturing group number of each rule's outer group -> (family, category)
+        self.groups: Dict[int, Tuple[str, str]] = {}
+        group = 1
+        for rule in rules:
+            try:
+                pattern = rule['regex'] if 'regex' in rule else re.escape(rule['match'])
+                inner_groups = re.compile(pattern).groups
+            except (KeyError, re.error) as e:
+                print(f"Skipping invalid user agent rule {rule}: {e}", file=sys.stderr)
+                continue
+            branches.append(f'.*?({pattern})')
+            self.groups[group] = (rule['family'], rule['category'])
+            group += 1 + inner_groups
+        self.pattern = re.compile('|'.join(branches), re.IGNORECASE | re.DOTALL) if branches else None
+        self.classify = lru_cache(maxsize=cache_size)(self._classify)
+
+    def _classify(self, user_agent: str) -> Tuple[str, str]:
+        if not user_agent or user_agent == '-':
+            return 'empty', 'other'
+        if self.pattern is not None:
+            match = self.pattern.match(user_agent)
+            if match:
+                return self.groups[match.lastindex]
+        match = BOT_PATTERN.search(user_agent)
+        if match:
+            return match.group(1), 'bot'
+        match = PRODUCT_PATTERN.match(user_agent)
+        if match and match.group(1) != 'Mozilla':
+            return match.group(1), 'tool'
+        return 'Other', 'other'
+
+
+# Status codes counted in SiteAggregate.status, indexed by code - STATUS_MIN
+STATUS_MIN, STATUS_MAX = 100, 599
+# Packed IPv6 addresses are offset so they never equal a packed IPv4 address
+IPV6_OFFSET = 1 << 128
+
+
+def pack_ip(ip: str):
+    """IPv4/IPv6 address as an int; anything else is returned unchanged"""
+    try:
+        if ':' in ip:
+            return IPV6_OFFSET + int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except (OSError, ValueError):
+        return ip
+
+
+def line_client_ip(line: str) -> str:
+    """Client IP of a raw log line without a full parse
+
+    GridPane lines start with [time], every other format with the client IP.
+    """
+    if line[:1] == '[':
+        start = line.find('] ') + 2
+        return line[start:line.find(' ', start)]
+    return line[:line.find(' ')]
+
+
+def line_time(line: str) -> Optional[datetime]:
+    """Time of a raw log line (the first [...] field) without a full parse"""
+    start = line.find('[') + 1
+    try:
+        return datetime.strptime(line[start:start + 20], '%d/%b/%Y:%H:%M:%S') if start else None
+    except ValueError:
+        return None
+
+
+def unpack_ip(value) -> str:
+    """Text form of a value returned by pack_ip"""
+    if isinstance(value, str):
+        return value
+    if value >= IPV6_OFFSET:
+        return socket.inet_ntop(socket.AF_INET6, (value - IPV6_OFFSET).to_bytes(16, 'big'))
+    return socket.inet_ntop(socket.AF_INET, value.to_bytes(4, 'big'))
+
+
+def load_prefix_table(path: str) -> List[Tuple[str, str, str]]:
+    """Read network,asn,provider rows (CSV, '#' comments) from an offline CIDR table"""
+    rows = []
+    try:
+        with open(path, newline='') as f:
+            for row in csv.reader(f):
+                if not row or row[0].startswith('#') or '/' not in row[0]:
+                    continue
+                rows.append((row[0].strip(), row[1].strip() if len(row) > 1 else '',
+                             row[2].strip() if len(row) > 2 else ''))
+    except OSError as e:
+        print(f"Error loading prefix table from {path}: {e}", file=sys.stderr)
+    return rows
+
+
+class PrefixTable:
+    """CIDR -> (ASN, provider) lookups by binary search over sorted arrays
+
+    Networks are kept as packed (see pack_ip) start and end addresses sorted
+    by start. CIDRs are either nested or disjoint, so each entry also records
+    the closest network enclosing it; a lookup bisects to the last start at
+    or below the address and walks out to the first network containing it,
+    which is the most specific one.
+    """
+
+    def __init__(self, rows: List[Tuple[str, str, str]]):
+        networks = []
+        for cidr, asn, provider in rows:
+            try:
+                network = ipaddress.ip_network(cidr, strict=False)
+            except ValueError:
+                continue
+            offset = IPV6_OFFSET if network.version == 6 else 0
+            start = offset + int(network.network_address)
+            # Wider networks first when two start at the same address
+            networks.append((start, -network.prefixlen, offset + int(network.broadcast_address), (asn, provider)))
+        networks.sort()
+
+        self.starts = [start for start, _, _, _ in networks]
+        self.ends = [end for _, _, end, _ in networks]
+        self.labels = [label for _, _, _, label in networks]
+        self.parents = []
+        stack: List[int] = []
+        for i, (start, _, end, _) in enumerate(networks):
+            while stack and self.ends[stack[-1]] < start:
+                stack.pop()
+            self.parents.append(stack[-1] if stack else -1)
+            stack.append(i)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def lookup(self, packed: int) -> Tuple[str, str]:
+        """(asn, provider) of the most specific network holding the address, or ('', '')"""
+        i = bisect_right(self.starts, packed) - 1
+        while i >= 0 and self.ends[i] < packed:
+            i = self.parents[i]
+        return self.labels[i] if i >= 0 else ('', '')
+
+
+class LineSampler:
+    """Deterministic line sampling for one site at a power-of-two rate
+
+    Clients are kept or dropped whole by the hash of their IP, so a sampled
+    client's counts are exact. A client that reaches HEAVY_CLIENT_LINES
+    (typically the source of a flood) would otherwise decide the estimate
+    on its own, so from then on every 1/rate-th of its lines is kept,
+    whatever its hash. Every kept line stands for 1/rate lines.
+
+    With a cutoff, lines older than it are dropped first (from the raw time
+    field, without a full parse), so only window lines count towards the
+    heavy clients and the error bound.
+    """
+
+    def __init__(self, rate: float, cutoff: Optional[datetime] = None):
+        self.rate = rate
+        self.factor = round(1 / rate)
+        self.threshold = int(rate * SAMPLE_SPACE)
+        self.cutoff = cutoff
+        # 'dd/Mon/yyyy:HH:MM' -> that minute
+        self.minutes: Dict[str, datetime] = {}
+        # client IP -> window lines seen, and lines kept by hash before the client got heavy
+        self.client_lines: Counter = Counter()
+        self.hashed_lines: Counter = Counter()
+
+    def in_window(self, line: str) -> bool:
+        start = line.find('[') + 1
+        if not start:
+            return True  # Left to the parser to reject
+        minute_text = line[start:start + 17]
+        minute = self.minutes.get(minute_text)
+        if minute is None:
+            try:
+                minute = datetime.strptime(minute_text, '%d/%b/%Y:%H:%M')
+            except ValueError:
+                minute = datetime.min
+            self.minutes[minute_text] = minute
+        cutoff = self.cutoff
+        if minute.hour != cutoff.hour or minute.minute != cutoff.minute or minute.date() != cutoff.date():
+            return minute > cutoff
+        second = line[start + 18:start + 20]
+        return second.isdigit() and int(second) >= cutoff.second
+
+    def sample(self, lines: List[str]) -> List[Tuple[str, int]]:
+        """The kept lines with the weight of their client's per-IP count"""
+        kept = []
+        client_lines, hashed_lines = self.client_lines, self.hashed_lines
+        factor, threshold, mask = self.factor, self.threshold, SAMPLE_SPACE - 1
+        in_window = self.in_window if self.cutoff else None
+        for line in lines:
+            if in_window and not in_window(line):
+                continue
+            ip = line_client_ip(line)
+            seen = client_lines[ip] = client_lines[ip] + 1
+            if seen > HEAVY_CLIENT_LINES:
+                if seen % factor == 0:
+                    kept.append((line, factor))
+            elif zlib.crc32(ip.encode()) & mask < threshold:
+                hashed_lines[ip] += 1
+                kept.append((line, 1))
+        return kept
+
+    def error_bound(self, requests: int) -> float:
+        """Relative 95% error bound of a request estimate of requests (sampled lines * 1/rate)"""
+        if not requests:
+            return 1.0
+        # Whole clients are hash-sampled: the variance comes from their
+        # per-client counts, (1 - p) / p^2 * sum(count^2). Heavy clients add
+        # the rounding of their every-Nth-line sampling
+        squares = sum(count * count for count in self.hashed_lines.values())
+        heavy = sum(1 for count in self.client_lines.values() if count > HEAVY_CLIENT_LINES)
+        variance = (1 - self.rate) * squares / (self.rate * self.rate) + heavy * self.factor ** 2 / 12
+        return 1.96 * math.sqrt(variance) / (requests * self.factor)
+
+
+class SiteAggregate:
+    """Window totals for one domain
+
+    IPs are kept packed into ints (see pack_ip) and status codes are counted
+    in a fixed array indexed by code.
+    """
+
+    __slots__ = ('requests', 'bytes', 'ips', 'user_agents', 'urls', 'agent_classes',
+                 'status', 'other_status', 'rollups', 'recent_requests', 'recent_bytes', 'recent_errors',
+                 'sample_rate', 'sample_error', 'heavy_ips')
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.ips: Counter = Counter()
+        self.user_agents: Counter = Counter()
+        self.urls: Counter = Counter()
+        # (category, family) -> requests
+        self.agent_classes: Counter = Counter()
+        self.status = array('I', bytes(4 * (STATUS_MAX - STATUS_MIN + 1)))
+        # Non-numeric or out of range status values, rarely needed
+        self.other_status: Optional[Counter] = None
+        # minute (unix seconds) -> rollup, only when a rollup store is configured
+        self.rollups: Optional[Dict[int, Dict]] = None
+        # The last RECENT_MINUTES of the window, observed by the site baselines
+        self.recent_requests = 0
+        self.recent_bytes = 0
+        self.recent_errors = 0
+        # Share of clients analyzed, and the relative 95% error bound of the
+        # request estimate when below 1
+        self.sample_rate = 1.0
+        self.sample_error = 0.0
+        # Packed IPs sampled line by line as heavy clients (see LineSampler)
+        self.heavy_ips: Optional[set] = None
+
+    def add_status(self, status: str):
+        code = int(status) if len(status) == 3 and status.isdigit() else 0
+        if STATUS_MIN <= code <= STATUS_MAX:
+            self.status[code - STATUS_MIN] += 1
+        else:
+            if self.other_status is None:
+                self.other_status = Counter()
+            self.other_status[status] += 1
+
+    def status_codes(self) -> Dict[str, int]:
+        """Requests by status code as text, only codes that were seen"""
+        codes = {str(i + STATUS_MIN): count for i, count in enumerate(self.status) if count}
+        if self.other_status:
+            codes.update(self.other_status)
+        return codes
+
+    def top_ips(self, n: int) -> List[Tuple[str, int]]:
+        return [(unpack_ip(ip), count) for ip, count in self.ips.most_common(n)]
+
+    def recent_values(self) -> Tuple[float, float, float]:
+        """(requests per minute, 5xx ratio, bytes per minute) over the recent minutes"""
+        error_ratio = self.recent_errors / self.recent_requests if self.recent_requests else 0.0
+        return self.recent_requests / RECENT_MINUTES, error_ratio, self.recent_bytes / RECENT_MINUTES
+
+    def scale_up(self, sampler: LineSampler):
+        """Turn the counts of the sampled lines into estimates for the whole site
+
+        Per-IP counts are left alone, they were weighted while counting (see
+        LineSampler.sample). Rates are powers of two, so counts stay integers.
+        """
+        self.sample_rate = sampler.rate
+        self.sample_error = sampler.error_bound(self.requests)
+        factor = sampler.factor
+        self.requests *= factor
+        self.bytes *= factor
+        self.recent_requests *= factor
+        self.recent_bytes *= factor
+        self.recent_errors *= factor
+        for i, count in enumerate(self.status):
+            if count:
+                self.status[i] = count * factor
+        counters = [self.user_agents, self.urls, self.agent_classes]
+        if self.other_status:
+            counters.append(self.other_status)
+        for rollup in (self.rollups or {}).values():
+            rollup['requests'] *= factor
+            rollup['bytes'] *= factor
+            counters += [rollup['status'], rollup['urls']]
+        for counter in counters:
+            for key in counter:
+                counter[key] *= factor
+
+
+class SeriesBudget:
+    """Caps the number of top-N label series the exporter emits
+
+    Each (family, domain) gets at most its top_n series, scaled down so the
+    top_n asked for in the previous collection fits within the limit. Series
+    that were emitted recently keep their slot, so the exported set stays the
+    same from scrape to scrape; a new value takes a slot while there is room,
+    or from the lowest held value when it outranks it. Slots are released
+    after `hold_cycles` collections without traffic. Cumulative counts are
+    ranked by their growth since the previous collection.
+    """
+
+    def __init__(self, limit: int, hold_cycles: int = 15):
+        self.limit = limit
+        self.hold_cycles = hold_cycles
+        self.cycle = 0
+        # (family, domain) -> {label value: last cycle with traffic}
+        self.admitted: Dict[Tuple[str, str], Dict[str, int]] = defaultdict(dict)
+        self.size = 0
+        self.rejected_total = 0
+        # Sum of top_n asked for in this and in the previous collection
+        self.demand = 0
+        self.last_demand = 0
+        # (family, domain) -> counts at the previous collection, cumulative families only
+        self.previous_counts: Dict[Tuple[str, str], Dict] = {}
+        self.selected_keys = set()
+
+    def start_cycle(self):
+        self.cycle += 1
+        self.last_demand, self.demand = self.demand, 0
+        self.previous_counts = {key: counts for key, counts in self.previous_counts.items() if key in self.selected_keys}
+        self.selected_keys = set()
+        expired_before = self.cycle - self.hold_cycles
+        for key in list(self.admitted):
+            values = self.admitted[key]
+            for value in [v for v, seen in values.items() if seen < expired_before]:
+                del values[value]
+                self.size -= 1
+            if not values:
+                del self.admitted[key]
+
+    def share(self, top_n: int) -> int:
+        """Series one (family, domain) may hold this collection"""
+        if self.last_demand <= self.limit:
+            return top_n
+        return max(1, top_n * self.limit // self.last_demand)
+
+    def select(self, family: str, domain: str, counts: Counter, top_n: int,
+               cumulative: bool = False) -> List[Tuple[str, int]]:
+        """Return the (value, count) pairs to emit for one domain and family, at most top_n"""
+        if self.limit <= 0:
+            return counts.most_common(top_n)
+
+        key = (family, domain)
+        self.demand += top_n
+        self.selected_keys.add(key)
+        cap = self.share(top_n)
+        if cumulative:
+            previous = self.previous_counts.get(key, {})
+            self.previous_counts[key] = dict(counts)
+            counts_now, counts = counts, Counter({value: count - previous.get(value, 0) for value, count in counts.items()})
+        else:
+            counts_now = counts
+
+        held = self.admitted[key]
+        # Held values rank by their traffic this collection, 0 without any
+        ranked = {}
+        for value in held:
+            count = counts.get(value, 0)
+            if count > 0:
+                held[value] = self.cycle
+            ranked[value] = count
+        for value, count in counts.most_common(cap):
+            if value in ranked or count <= 0:
+                continue
+            if len(ranked) >= cap:
+                lowest = min(ranked, key=ranked.get)
+                if ranked[lowest] >= count:
+                    self.rejected_total += 1
+                    continue
+                del held[lowest], ranked[lowest]
+                self.size -= 1
+            elif self.size >= self.limit:
+                self.rejected_total += 1
+                continue
+            held[value] = self.cycle
+            self.size += 1
+            ranked[value] = count
+        # A smaller share than last collection releases the lowest values
+        while len(ranked) > cap:
+            lowest = min(ranked, key=ranked.get)
+            del held[lowest], ranked[lowest]
+            self.size -= 1
+        # Cumulative series keep reporting their total while they hold a slot
+        selected = [(value, counts_now.get(value, 0)) for value in ranked]
+        return sorted((item for item in selected if item[1]), key=lambda item: item[1], reverse=True)
+
+
+class AccessLogCounters:
+    """Process-lifetime request, byte and status counts per domain
+
+    Fed only with the lines appended since the previous collection, so the
+    counts never go down and rate()/increase() work on them.
+    """
+
+    def __init__(self):
+        self.tail = LogTail()
+        self.requests: Counter = Counter()
+        self.bytes: Counter = Counter()
+        # domain -> Counter of status codes
+        self.status: Dict[str, Counter] = {}
+
+    def update(self, log_files: Dict[str, List[str]], parse_line,
+               sample_rates: Optional[Dict[str, float]] = None) -> int:
+        """Count the new lines of the current (uncompressed) logs; returns unparsed lines
+
+        Domains with a sample rate below 1 only have the lines of sampled
+        clients parsed, and the counts are scaled up.
+        """
+        domains = {path: domain for domain, paths in log_files.items() for path in paths if not path.endswith('.gz')}
+        sample_rates = sample_rates or {}
+        unparsed = 0
+        for path, lines in self.tail.read_new(domains):
+            domain = domains[path]
+            requests = size_total = 0
+            status = Counter()
+            rate = sample_rates.get(domain, 1.0)
+            if rate < 1:
+                lines = [line for line, _ in LineSampler(rate).sample(lines)]
+            for line in lines:
+                entry = parse_line(line)
+                if not entry:
+                    unparsed += 1
+                    continue
+                requests += 1
+                size = entry.get('size', '0')
+                if size.isdigit():
+                    size_total += int(size)
+                status[entry.get('status', 'unknown')] += 1
+            factor = round(1 / rate)
+            self.requests[domain] += requests * factor
+            self.bytes[domain] += size_total * factor
+            domain_status = self.status.setdefault(domain, Counter())
+            for code, count in status.items():
+                domain_status[code] += count * factor
+        return unparsed
+
 
 class LogAnalyzer:
-    def __init__(self, platform_info: Dict, window_minutes: int = 15):
+    def __init__(self, platform_info: Dict, window_minutes: int = 15,
+                 url_normalizer: Optional[UrlNormalizer] = None, ua_families: bool = True,
+                 series_budget: int = 3000, ua_classifier: Optional[UserAgentClassifier] = None,
+                 rollup_store: Optional[RollupStore] = None, counter_mode: str = 'window',
+                 ipv4_prefix: int = 24, ipv6_prefix: int = 48, prefix_table: Optional[PrefixTable] = None,
+                 baselines: Optional[SiteBaselines] = None, sample_budget: int = 0):
         self.platform_info = platform_info
         self.platform = platform_info.get('platform', 'unknown')
         self.window_minutes = window_minutes
         self.cutoff_time = datetime.now() - timedelta(minutes=window_minutes)
+        self.url_normalizer = url_normalizer or UrlNormalizer()
+        self.ua_families = ua_families
+        self.ua_classifier = ua_classifier or UserAgentClassifier(load_user_agent_rules(UA_RULES_FILE))
+        self.series_budget = SeriesBudget(series_budget)
+        self.error_logs = ErrorLogAnalyzer()
+        self.slowlogs = SlowlogAnalyzer()
+        self.rollup_store = rollup_store
+        # Client network prefixes, 0 disables one address family. The IPv6
+        # mask keeps the bit marking packed IPv6 addresses
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.ipv4_mask = ((1 << ipv4_prefix) - 1) << (32 - ipv4_prefix)
+        self.ipv6_mask = IPV6_OFFSET | ((1 << ipv6_prefix) - 1) << (128 - ipv6_prefix) if ipv6_prefix else 0
+        self.prefix_table = prefix_table
+        # Per-site anomaly baselines (kept in memory only unless a state file is given)
+        self.baselines = baselines or SiteBaselines(state_file=None)
+        self.recent_cutoff = datetime.now() - timedelta(minutes=RECENT_MINUTES)
+        self.counter_mode = counter_mode
+        self.access_counters = AccessLogCounters() if counter_mode == 'cumulative' else None
+        # domain -> newest minute already persisted to the rollup store
+        self.rollup_written: Dict[str, int] = {}
+        # Lines per domain and collection above which lines are sampled by
+        # client IP, 0 to always analyze every line
+        self.sample_budget = sample_budget
+        # domain -> sample rate and (estimated) window requests of the last analysis
+        self.sample_rates: Dict[str, float] = {}
+        self.window_lines: Dict[str, int] = {}
+
+        self.stats = ExporterStats('log-analyzer')
+        self.stats.describe('sqcdy_log_lines_read_total', 'Log lines read')
+        self.stats.describe('sqcdy_log_lines_parsed_total', 'Log lines parsed, by log format', ('format',))
+        self.stats.describe('sqcdy_log_lines_unparsed_total', 'Log lines that matched no known log format')
+        self.stats.describe('sqcdy_log_bytes_read_total', 'Bytes of log data read')
+        self.stats.describe('sqcdy_log_lines_sampled_out_total', 'Log lines of sampled sites that were not parsed (not sampled or outside the window)')
+        self.stats.describe('sqcdy_log_tail_bytes_read_total', 'Bytes read incrementally from access, error and slow logs')
+        self.stats.describe('sqcdy_log_site_analysis_seconds', 'Time spent analyzing the site logs in the last collection',
+                            ('domain',), metric_type='gauge')
     
-    def get_log_files(self) -> Dict[str, List[str]]:
-        """Get log files grouped by site/domain"""
+    def get_log_files(self, kind: str = 'access') -> Dict[str, List[str]]:
+        """Get access (or error) log files grouped by site/domain"""
         log_files = defaultdict(list)
+        names = LOG_KINDS[kind]
         
         if self.platform == 'plesk':
             # Plesk: /var/www/vhosts/DOMAIN/logs/access_ssl_log (current logs)
@@ -74,7 +720,7 @@ class LogAnalyzer:
                         logs_dir = domain_dir / 'logs'
                         if logs_dir.exists():
                             # Main domain logs
-                            for log_name in ['access_ssl_log', 'proxy_access_ssl_log', 'access_log', 'proxy_access_log']:
+                            for log_name in names['plesk']:
                                 log_file = logs_dir / log_name
                                 if log_file.exists() and log_file.stat().st_size > 0:
                                     log_files[domain_dir.name].append(str(log_file))
@@ -83,7 +729,7 @@ class LogAnalyzer:
                             for subdomain_dir in logs_dir.iterdir():
                                 if subdomain_dir.is_dir():
                                     subdomain_name = subdomain_dir.name
-                                    for log_name in ['access_ssl_log', 'proxy_access_ssl_log', 'access_log', 'proxy_access_log']:
+                                    for log_name in names['plesk']:
                                         log_file = subdomain_dir / log_name
                                         if log_file.exists() and log_file.stat().st_size > 0:
                                             log_files[subdomain_name].append(str(log_file))
@@ -99,15 +745,15 @@ class LogAnalyzer:
                     filename = log_file.name
                     
                     # Only current access logs (not rotated .log.1, .log.gz, etc.)
-                    if not filename.endswith('.access.log'):
+                    if not filename.endswith(names['gridpane']):
                         continue
                     
                     # Skip system logs
-                    if filename == 'access.log':
+                    if filename == names['gridpane'][1:]:
                         continue
                     
                     # Extract domain: remove .access.log suffix
-                    domain = filename.replace('.access.log', '')
+                    domain = filename[:-len(names['gridpane'])]
                     # Filter out system domains and gridpanevps.com
                     if domain in ['22222', 'core']:
                         continue
@@ -123,8 +769,14 @@ class LogAnalyzer:
             # This is the ONLY supported Ubuntu structure - fail if it doesn't exist
             sites_path = Path('/var/www/sites')
             if not sites_path.exists():
-                print(f"ERROR: Unsupported platform '{self.platform}' - /var/www/sites structure not found", file=sys.stderr)
-                print("Supported platforms: plesk, gridpane, ubuntu-nginx with /var/www/sites/USER/DOMAIN/logs/", file=sys.stderr)
+                # Otherwise use the access logs declared in the nginx/Apache vhosts
+                for domain, vhost in VHOST_CONFIG.get_sites().items():
+                    files = [f for f in vhost[names['vhost']] if os.path.isfile(f) and os.path.getsize(f) > 0]
+                    if files:
+                        log_files[domain].extend(files)
+                if not log_files and kind == 'access':
+                    print(f"ERROR: Unsupported platform '{self.platform}' - no /var/www/sites structure or vhost access logs found", file=sys.stderr)
+                    print("Supported platforms: plesk, gridpane, ubuntu-nginx with /var/www/sites/USER/DOMAIN/logs/ or per-vhost access_log", file=sys.stderr)
                 return log_files
             
             for user_dir in sites_path.iterdir():
@@ -140,7 +792,7 @@ class LogAnalyzer:
                     domain = domain_dir.name
                     logs_dir = domain_dir / 'logs'
                     if logs_dir.exists():
-                        for log_file in logs_dir.glob('*access*.log'):
+                        for log_file in logs_dir.glob(names['ubuntu']):
                             if log_file.is_file() and log_file.stat().st_size > 0:
                                 log_files[domain].append(str(log_file))
         
@@ -153,20 +805,25 @@ class LogAnalyzer:
             match = GRIDPANE_LOG_PATTERN.match(line)
             if match:
                 data = match.groupdict()
+                self.stats.inc('sqcdy_log_lines_parsed_total', 1, 'gridpane')
                 return data
         
         # Try Ubuntu Cloudflare format (3 IPs)
         match = UBUNTU_CLOUDFLARE_LOG_PATTERN.match(line)
         if match:
+            self.stats.inc('sqcdy_log_lines_parsed_total', 1, 'ubuntu_cloudflare')
             return match.groupdict()
         
         # Try standard nginx format
+        log_format = 'nginx'
         match = NGINX_LOG_PATTERN.match(line)
         if not match:
             # Try apache format
+            log_format = 'apache'
             match = APACHE_LOG_PATTERN.match(line)
         
         if match:
+            self.stats.inc('sqcdy_log_lines_parsed_total', 1, log_format)
             data = match.groupdict()
             # Set default user_agent if not captured
             if 'user_agent' not in data:
@@ -183,26 +840,41 @@ class LogAnalyzer:
         except:
             return datetime.min
     
-    def analyze_site_logs(self, domain: str, log_files: List[str]) -> Dict:
+    def sample_rate(self, domain: str) -> float:
+        """Share of clients to analyze so the domain's window lines stay near the line budget
+
+        Based on the window requests of the previous collection, so only sites
+        that are busy right now are sampled (never the first collection).
+        """
+        if self.sample_budget <= 0:
+            return 1.0
+        expected = self.window_lines.get(domain, 0)
+        rate = 1.0
+        while expected * rate > self.sample_budget and rate > MIN_SAMPLE_RATE:
+            rate /= 2
+        return rate
+
+    def analyze_site_logs(self, domain: str, log_files: List[str]) -> SiteAggregate:
         """Analyze logs for a single site"""
-        metrics = {
-            'requests_total': 0,
-            'bytes_total': 0,
-            'requests_per_minute': 0,
-            'bytes_per_minute': 0,
-            'top_ips': Counter(),
-            'top_user_agents': Counter(),
-            'top_urls': Counter(),
-            'status_codes': Counter()
-        }
-        
-        max_lines_per_file = 50000  # Safety cap on lines read per file
-        # Read last 5MB of large files so we reach recent log entries efficiently
-        TAIL_BYTES = 5 * 1024 * 1024
+        metrics = SiteAggregate()
+        rate = self.sample_rates[domain] = self.sample_rate(domain)
+        sampler = LineSampler(rate, self.cutoff_time) if rate < 1 else None
+        if self.rollup_store:
+            metrics.rollups = defaultdict(new_rollup)
+        rollups = metrics.rollups
+        ips, user_agents, urls, agent_classes = metrics.ips, metrics.user_agents, metrics.urls, metrics.agent_classes
+        recent_cutoff = self.recent_cutoff
+        # Log time up to the minute -> minute start in unix seconds
+        minute_starts: Dict[str, int] = {}
 
+        unparsed = sampled_out = 0
+        # Rollup minutes at or before cut_before and at or after cut_after are
+        # partial, because a file was only read from its tail or up to the line cap
+        cut_before = cut_after = None
         for log_file in log_files:
             try:
                 lines_read = 0
+                tail_only = False
                 # Handle gzipped files
                 if log_file.endswith('.gz'):
                     f = gzip.open(log_file, 'rt', errors='ignore')
@@ -213,134 +885,336 @@ class LogAnalyzer:
                         if file_size > TAIL_BYTES:
                             raw.seek(file_size - TAIL_BYTES)
                             raw.readline()  # Discard partial first line after seek
+                            tail_only = True
                     except OSError:
                         pass
                     f = raw
 
                 with f:
-                    for line in f:
-                        if lines_read >= max_lines_per_file:
+                    # Work in batches so read, parse and aggregate can be timed
+                    # separately without a timer call per line
+                    while lines_read < MAX_LINES_PER_FILE:
+                        with self.stats.phase('read'):
+                            batch = list(islice(f, min(BATCH_LINES, MAX_LINES_PER_FILE - lines_read)))
+                        if not batch:
                             break
-                        lines_read += 1
-                        
-                        entry = self.parse_log_line(line)
-                        if not entry:
-                            continue
-                        
-                        # Check if within time window
-                        log_time = self.parse_time(entry.get('time', ''))
-                        if log_time < self.cutoff_time:
-                            continue
-                        
-                        # Count request
-                        metrics['requests_total'] += 1
-                        
-                        # Sum bytes
-                        try:
-                            size = int(entry.get('size', 0))
-                            metrics['bytes_total'] += size
-                        except:
-                            pass
-                        
-                        # Track top IPs
-                        ip = entry.get('ip', 'unknown')
-                        metrics['top_ips'][ip] += 1
-                        
-                        # Track top user agents
-                        ua = entry.get('user_agent', 'unknown')[:100]  # Truncate long UAs
-                        if ua and ua != '-':
-                            metrics['top_user_agents'][ua] += 1
-                        
-                        # Track top URLs
-                        url = entry.get('url', 'unknown')[:200]  # Truncate long URLs
-                        metrics['top_urls'][url] += 1
-                        
-                        # Track status codes
-                        status = entry.get('status', 'unknown')
-                        metrics['status_codes'][status] += 1
+                        if rollups is not None:
+                            if tail_only and lines_read == 0:
+                                first_time = line_time(batch[0])
+                                if first_time and first_time >= self.cutoff_time and (cut_before is None or first_time > cut_before):
+                                    cut_before = first_time
+                            if lines_read + len(batch) >= MAX_LINES_PER_FILE:
+                                last_time = line_time(batch[-1])
+                                if last_time and (cut_after is None or last_time < cut_after):
+                                    cut_after = last_time
+                        lines_read += len(batch)
+                        self.stats.inc('sqcdy_log_lines_read_total', len(batch))
+                        self.stats.inc('sqcdy_log_bytes_read_total', sum(map(len, batch)))
+
+                        with self.stats.phase('parse'):
+                            # (line, weight of the line in its client's count)
+                            if sampler:
+                                weighted = sampler.sample(batch)
+                                sampled_out += len(batch) - len(weighted)
+                            else:
+                                weighted = zip(batch, repeat(1))
+                            entries = []
+                            for line, weight in weighted:
+                                entry = self.parse_log_line(line)
+                                if not entry:
+                                    unparsed += 1
+                                    continue
+                                # Check if within time window
+                                timestamp = self.parse_time(entry.get('time', ''))
+                                if timestamp >= self.cutoff_time:
+                                    entries.append((entry, timestamp, weight))
+
+                        with self.stats.phase('aggregate'):
+                            for entry, timestamp, weight in entries:
+                                # Count request
+                                metrics.requests += 1
+                                
+                                # Sum bytes
+                                size = entry.get('size', '0')
+                                size = int(size) if size.isdigit() else 0
+                                metrics.bytes += size
+                                
+                                # Track top IPs
+                                ip = entry.get('ip', 'unknown')
+                                packed = pack_ip(ip)
+                                ips[packed] += weight
+                                if weight > 1:
+                                    if metrics.heavy_ips is None:
+                                        metrics.heavy_ips = set()
+                                    metrics.heavy_ips.add(packed)
+                                
+                                # Track user agent classes and top user agents
+                                ua = entry.get('user_agent', 'unknown')
+                                family, category = self.ua_classifier.classify(ua)
+                                agent_classes[(category, family)] += 1
+                                if ua and ua != '-':
+                                    ua = family if self.ua_families else ua[:100]  # Truncate long UAs
+                                    user_agents[ua] += 1
+                                
+                                # Track top URLs
+                                url = self.url_normalizer.normalize(entry.get('url', 'unknown'))
+                                urls[url] += 1
+                                
+                                # Track status codes
+                                status = entry.get('status', 'unknown')
+                                metrics.add_status(status)
+
+                                if timestamp >= recent_cutoff:
+                                    metrics.recent_requests += 1
+                                    metrics.recent_bytes += size
+                                    if status[:1] == '5':
+                                        metrics.recent_errors += 1
+
+                                # Per-minute rollup for the rollup store
+                                if rollups is not None:
+                                    minute_key = entry['time'][:17]
+                                    minute = minute_starts.get(minute_key)
+                                    if minute is None:
+                                        minute = minute_starts[minute_key] = int(timestamp.timestamp()) // 60 * 60
+                                    rollup = rollups[minute]
+                                    rollup['requests'] += 1
+                                    rollup['bytes'] += size
+                                    rollup['status'][status] += 1
+                                    rollup['ips'][ip] += weight
+                                    rollup['urls'][url] += 1
             
             except Exception as e:
                 print(f"Error reading {log_file}: {e}", file=sys.stderr)
                 continue
         
-        # Calculate per-minute rates
-        if self.window_minutes > 0:
-            metrics['requests_per_minute'] = metrics['requests_total'] / self.window_minutes
-            metrics['bytes_per_minute'] = metrics['bytes_total'] / self.window_minutes
-        
+        self.stats.inc('sqcdy_log_lines_unparsed_total', unparsed)
+        if rollups and (cut_before or cut_after):
+            first = int(cut_before.timestamp()) // 60 * 60 + 60 if cut_before else 0
+            last = int(cut_after.timestamp()) // 60 * 60 - 60 if cut_after else float('inf')
+            for minute in [minute for minute in rollups if not first <= minute <= last]:
+                del rollups[minute]
+        if sampler:
+            self.stats.inc('sqcdy_log_lines_sampled_out_total', sampled_out)
+            metrics.scale_up(sampler)
+        self.window_lines[domain] = metrics.requests
         return metrics
     
-    def collect_metrics(self) -> str:
-        """Collect all metrics in Prometheus format"""
+    def collect_metrics(self) -> MetricRegistry:
+        """Collect all metrics into a registry"""
         # Recalculate cutoff time on every collection run (not just at startup)
         self.cutoff_time = datetime.now() - timedelta(minutes=self.window_minutes)
+        self.recent_cutoff = datetime.now() - timedelta(minutes=RECENT_MINUTES)
+        self.stats.start_collection()
+        start_time = time.time()
 
-        output = []
+        registry = MetricRegistry()
         # Get hostname for instance label
         instance = os.uname()[1] if hasattr(os, 'uname') else os.getenv('HOSTNAME', 'unknown')
         
-        # Headers
-        output.append("# HELP sqcdy_site_requests_total Total HTTP requests in time window")
-        output.append("# TYPE sqcdy_site_requests_total counter")
-        output.append("# HELP sqcdy_site_traffic_bytes Total traffic in bytes in time window")
-        output.append("# TYPE sqcdy_site_traffic_bytes counter")
-        output.append("# HELP sqcdy_site_requests_per_minute Requests per minute")
-        output.append("# TYPE sqcdy_site_requests_per_minute gauge")
-        output.append("# HELP sqcdy_site_bytes_per_minute Bytes per minute")
-        output.append("# TYPE sqcdy_site_bytes_per_minute gauge")
-        output.append("# HELP sqcdy_site_top_ip_requests Requests from top IP addresses")
-        output.append("# TYPE sqcdy_site_top_ip_requests counter")
-        output.append("# HELP sqcdy_site_top_user_agent_requests Requests from top user agents")
-        output.append("# TYPE sqcdy_site_top_user_agent_requests counter")
-        output.append("# HELP sqcdy_site_top_url_requests Requests to top URLs")
-        output.append("# TYPE sqcdy_site_top_url_requests counter")
-        output.append("# HELP sqcdy_site_status_code_total Requests by status code")
-        output.append("# TYPE sqcdy_site_status_code_total counter")
+        # Register site families up front so they render in this order
+        site_labels = ('instance', 'domain')
+        for name, help_text, metric_type, labels in SITE_FAMILIES:
+            if self.access_counters:
+                help_text = CUMULATIVE_HELP.get(name, help_text)
+            registry.family(name, help_text, metric_type, site_labels + labels)
         
-        log_files = self.get_log_files()
+        with self.stats.phase('discovery'):
+            log_files = self.get_log_files()
+        self.series_budget.start_cycle()
+
+        if self.access_counters:
+            # Lifetime counters from the lines appended since the last collection
+            with self.stats.phase('access_tail'):
+                unparsed = self.access_counters.update(log_files, self.parse_log_line, self.sample_rates)
+            self.stats.inc('sqcdy_log_lines_unparsed_total', unparsed)
         
         for domain, files in log_files.items():
             print(f"Analyzing logs for {domain}...", file=sys.stderr)
+            site_start = time.perf_counter()
             metrics = self.analyze_site_logs(domain, files)
+            self.stats.set('sqcdy_log_site_analysis_seconds', time.perf_counter() - site_start, domain)
 
-            # Basic metrics
-            output.append(f'sqcdy_site_requests_total{{instance="{instance}",domain="{domain}"}} {metrics["requests_total"]}')
-            output.append(f'sqcdy_site_traffic_bytes{{instance="{instance}",domain="{domain}"}} {metrics["bytes_total"]}')
-            output.append(f'sqcdy_site_requests_per_minute{{instance="{instance}",domain="{domain}"}} {metrics["requests_per_minute"]:.2f}')
-            output.append(f'sqcdy_site_bytes_per_minute{{instance="{instance}",domain="{domain}"}} {metrics["bytes_per_minute"]:.2f}')
-
-            # Top IPs (top 10)
-            for ip, count in metrics['top_ips'].most_common(10):
-                safe_ip = ip.replace('"', '\\"')
-                output.append(f'sqcdy_site_top_ip_requests{{instance="{instance}",domain="{domain}",ip="{safe_ip}"}} {count}')
-
-            # Top User Agents (top 10)
-            for ua, count in metrics['top_user_agents'].most_common(10):
-                safe_ua = ua.replace('"', '\\"').replace('\\', '\\\\')
-                output.append(f'sqcdy_site_top_user_agent_requests{{instance="{instance}",domain="{domain}",user_agent="{safe_ua}"}} {count}')
-
-            # Top URLs (top 20)
-            for url, count in metrics['top_urls'].most_common(20):
-                safe_url = url.replace('"', '\\"').replace('\\', '\\\\')
-                output.append(f'sqcdy_site_top_url_requests{{instance="{instance}",domain="{domain}",url="{safe_url}"}} {count}')
-
-            # Status codes
-            for status, count in metrics['status_codes'].items():
-                output.append(f'sqcdy_site_status_code_total{{instance="{instance}",domain="{domain}",status="{status}"}} {count}')
+            if self.rollup_store:
+                with self.stats.phase('rollups'):
+                    self._store_rollups(domain, metrics.rollups)
+
+            with self.stats.phase('render'):
+                self._add_site(registry, instance, domain, metrics)
         
-        # Metadata
-        output.append(f'# HELP sqcdy_log_analysis_window_minutes Analysis time window in minutes')
-        output.append(f'sqcdy_log_analysis_window_minutes {self.window_minutes}')
-        output.append(f'sqcdy_sites_with_logs_total {len(log_files)}')
+        if self.rollup_store:
+            with self.stats.phase('rollups'):
+                self.rollup_store.maintain()
+
+        self.baselines.maintain()
+
+        # Error logs and PHP-FPM slowlogs, read incrementally
+        with self.stats.phase('error_logs'):
+            self.error_logs.update(self.get_log_files('error'))
+        with self.stats.phase('slowlogs'):
+            self.slowlogs.update(find_slowlogs(), log_files)
+        tail_bytes = self.error_logs.tail.bytes_read + self.slowlogs.tail.bytes_read
+        if self.access_counters:
+            tail_bytes += self.access_counters.tail.bytes_read
+        self.stats.set('sqcdy_log_tail_bytes_read_total', tail_bytes)
+        with self.stats.phase('render'):
+            self._add_error_logs(registry, instance)
         
-        return '\n'.join(output) + '\n'
+        # Metadata
+        registry.family('sqcdy_log_analysis_window_minutes', 'Analysis time window in minutes',
+                        'untyped').add(self.window_minutes)
+        registry.family('sqcdy_sites_with_logs_total', 'Sites with access logs found',
+                        'untyped').add(len(log_files))
+        registry.family('sqcdy_series_budget_limit', 'Maximum top IP/URL/user agent series this exporter emits',
+                        'gauge', ('instance',)).add(self.series_budget.limit, instance)
+        registry.family('sqcdy_series_budget_used', 'Top IP/URL/user agent series currently holding a slot',
+                        'gauge', ('instance',)).add(self.series_budget.size, instance)
+        registry.family('sqcdy_series_budget_rejected_total', 'Top-N values not exported because the budget was full',
+                        'counter', ('instance',)).add(self.series_budget.rejected_total, instance)
+
+        self.stats.finish_collection(time.time() - start_time)
+        return self.stats.add_to(registry)
+
+    def _store_rollups(self, domain: str, rollups: Dict[int, Dict]):
+        """Persist the complete minutes of this window not yet written"""
+        # The first minute of the window is cut off by the cutoff and the
+        # current one is still filling; neither is complete
+        first = int(self.cutoff_time.timestamp()) // 60 * 60 + 60
+        last = int(time.time()) // 60 * 60 - 60
+        first = max(first, self.rollup_written.get(domain, 0) + 60)
+        complete = {minute: rollup for minute, rollup in rollups.items() if first <= minute <= last}
+        if not complete:
+            return
+        try:
+            self.rollup_store.append(domain, complete)
+            self.rollup_written[domain] = max(complete)
+        except OSError as e:
+            print(f"Error writing rollups for {domain}: {e}", file=sys.stderr)
+
+    def _add_error_logs(self, registry: MetricRegistry, instance: str):
+        """Add the cumulative error log and slowlog counters"""
+        families = registry.families
+
+        family = families['sqcdy_site_error_log_lines_total']
+        for (domain, severity, error_class), count in sorted(self.error_logs.counts.items()):
+            family.add(count, instance, domain, severity, error_class)
+
+        family = families['sqcdy_site_php_slow_requests_total']
+        for domain, count in sorted(self.slowlogs.requests.items()):
+            family.add(count, instance, domain)
+
+        # Top frames (top 10 per domain)
+        family = families['sqcdy_site_php_slow_frames_total']
+        for domain, frames in sorted(self.slowlogs.frames.items()):
+            for (function, file_path), count in self.series_budget.select('slow_frame', domain, frames, 10, cumulative=True):
+                family.add(count, instance, domain, function, file_path)
+
+    def _add_site(self, registry: MetricRegistry, instance: str, domain: str, metrics: SiteAggregate):
+        """Add the samples for one site to the registry"""
+        families = registry.families
+        status_codes = metrics.status_codes()
+
+        # Basic metrics
+        families['sqcdy_site_window_requests'].add(metrics.requests, instance, domain)
+        families['sqcdy_site_window_traffic_bytes'].add(metrics.bytes, instance, domain)
+        family = families['sqcdy_site_window_status_code_requests']
+        for status, count in status_codes.items():
+            family.add(count, instance, domain, status)
+
+        counters = self.access_counters
+        if counters:
+            families['sqcdy_site_requests_total'].add(counters.requests[domain], instance, domain)
+            families['sqcdy_site_traffic_bytes'].add(counters.bytes[domain], instance, domain)
+            family = families['sqcdy_site_status_code_total']
+            for status, count in counters.status.get(domain, {}).items():
+                family.add(count, instance, domain, status)
+        else:
+            # Window totals under the historical counter names
+            families['sqcdy_site_requests_total'].add(metrics.requests, instance, domain)
+            families['sqcdy_site_traffic_bytes'].add(metrics.bytes, instance, domain)
+            family = families['sqcdy_site_status_code_total']
+            for status, count in status_codes.items():
+                family.add(count, instance, domain, status)
+
+        # Per-minute rates
+        minutes = self.window_minutes if self.window_minutes > 0 else 1
+        families['sqcdy_site_requests_per_minute'].add(round(metrics.requests / minutes, 2), instance, domain)
+        families['sqcdy_site_bytes_per_minute'].add(round(metrics.bytes / minutes, 2), instance, domain)
+
+        # Line sampling on busy sites
+        families['sqcdy_site_sampling_rate'].add(metrics.sample_rate, instance, domain)
+        families['sqcdy_site_sampling_error_ratio'].add(round(metrics.sample_error, 4), instance, domain)
+
+        # Anomaly scores against the site's baseline (absent until it has enough history)
+        observed = self.baselines.observe(domain, metrics.recent_values())
+        for name, key in (('sqcdy_site_request_anomaly_score', 'requests_score'),
+                          ('sqcdy_site_error_ratio_anomaly_score', 'error_ratio_score'),
+                          ('sqcdy_site_bytes_anomaly_score', 'bytes_score'),
+                          ('sqcdy_site_request_baseline_per_minute', 'requests_baseline')):
+            if observed[key] is not None:
+                families[name].add(round(observed[key], 3), instance, domain)
+
+        # Top IPs (top 10)
+        family = families['sqcdy_site_top_ip_requests']
+        for ip, count in self.series_budget.select('ip', domain, metrics.ips, 10):
+            family.add(count, instance, domain, unpack_ip(ip))
+
+        # Top network prefixes (top 10)
+        if self.ipv4_mask or self.ipv6_mask:
+            self._add_prefixes(families, instance, domain, metrics)
+
+        # Top User Agents (top 10)
+        family = families['sqcdy_site_top_user_agent_requests']
+        for ua, count in self.series_budget.select('user_agent', domain, metrics.user_agents, 10):
+            family.add(count, instance, domain, ua)
+
+        # Top URLs (top 20)
+        family = families['sqcdy_site_top_url_requests']
+        for url, count in self.series_budget.select('url', domain, metrics.urls, 20):
+            family.add(count, instance, domain, url)
+
+        # User agent classes
+        family = families['sqcdy_site_requests_by_agent_class']
+        for (category, agent_family), count in self.series_budget.select('agent_class', domain, metrics.agent_classes, 25):
+            family.add(count, instance, domain, category, agent_family)
+
+    def _add_prefixes(self, families: Dict, instance: str, domain: str, metrics: SiteAggregate):
+        """Top client prefixes with their request and distinct address counts
+
+        Built from the per-IP counts here rather than kept per domain, so
+        the prefix tables only exist while one site is being exported.
+        """
+        # Hash-sampled addresses stand for 1/rate addresses and their counts
+        # are exact; heavy clients are kept whatever their hash and their
+        # counts are already estimates (see LineSampler)
+        factor = round(1 / metrics.sample_rate)
+        heavy_ips = metrics.heavy_ips or ()
+        requests, addresses = Counter(), Counter()
+        ipv4_mask, ipv6_mask = self.ipv4_mask, self.ipv6_mask
+        for packed, count in metrics.ips.items():
+            if type(packed) is int:
+                mask = ipv6_mask if packed >= IPV6_OFFSET else ipv4_mask
+                if mask:
+                    scale = 1 if packed in heavy_ips else factor
+                    requests[packed & mask] += count * scale
+                    addresses[packed & mask] += scale
+
+        requests_family = families['sqcdy_site_top_prefix_requests']
+        addresses_family = families['sqcdy_site_top_prefix_addresses']
+        for network, count in self.series_budget.select('prefix', domain, requests, 10):
+            bits = self.ipv6_prefix if network >= IPV6_OFFSET else self.ipv4_prefix
+            prefix = f'{unpack_ip(network)}/{bits}'
+            asn, provider = self.prefix_table.lookup(network) if self.prefix_table else ('', '')
+            requests_family.add(count, instance, domain, prefix, asn, provider)
+            addresses_family.add(addresses[network], instance, domain, prefix, asn, provider)
 
 
 class MetricsHandler(BaseHTTPRequestHandler):
     """HTTP handler for Prometheus metrics endpoint"""
     
     analyzer = None
-    cached_metrics = ""
+    profiler = None  # set when --enable-profiler is given
+    rollup_store = None  # set when --rollup-dir is given
+    cached_metrics = MetricRegistry()
     last_update = 0
     update_interval = 55  # Update cache every 55 seconds (offset from 60s scrape interval)
     lock = threading.Lock()
@@ -364,6 +1238,7 @@ class MetricsHandler(BaseHTTPRequestHandler):
                     
             except Exception as e:
                 print(f"Error updating metrics cache: {e}", file=sys.stderr, flush=True)
+                cls.analyzer.stats.finish_collection(time.time() - start_time, success=False)
                 # Keep old metrics on error
             
             # Sleep until next update
@@ -374,15 +1249,22 @@ class MetricsHandler(BaseHTTPRequestHandler):
             try:
                 # Return cached metrics
                 with self.lock:
-                    metrics = self.cached_metrics
+                    registry = self.cached_metrics
                 
+                openmetrics = wants_openmetrics(self.headers.get('Accept'))
+                body = registry.render(openmetrics)
                 self.send_response(200)
-                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Type', CONTENT_TYPE_OPENMETRICS if openmetrics else CONTENT_TYPE_TEXT)
+                self.send_header('Content-Length', str(len(body)))
                 self.end_headers()
-                self.wfile.write(metrics.encode('utf-8'))
+                self.wfile.write(body)
             except Exception as e:
                 print(f"Error: {e}", file=sys.stderr)
                 self.send_error(500, f"Error collecting metrics: {e}")
+        elif self.path.split('?')[0] == '/debug/profile' and self.profiler:
+            handle_profile_request(self, self.profiler)
+        elif self.path.split('?')[0] == '/query' and self.rollup_store:
+            handle_query_request(self, self.rollup_store)
         else:
             self.send_error(404)
     
@@ -391,46 +1273,78 @@ class MetricsHandler(BaseHTTPRequestHandler):
         pass
 
 
-def get_platform_info() -> Dict:
-    """Get platform detection info"""
-    try:
-        script_dir = Path(__file__).parent
-        result = subprocess.run(
-            ['/bin/bash', str(script_dir / 'platform-detect.sh'), '--json'],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        return json.loads(result.stdout)
-    except Exception as e:
-        print(f"Error detecting platform: {e}", file=sys.stderr)
-        return {'platform': 'unknown'}
-
-
 def main():
     parser = argparse.ArgumentParser(description='Square Candy Log Analyzer & Traffic Metrics')
     parser.add_argument('--port', type=int, default=9103, help='Port to listen on (default: 9103)')
     parser.add_argument('--window', type=int, default=15, help='Analysis time window in minutes (default: 15)')
     parser.add_argument('--test', action='store_true', help='Run once and print metrics to stdout')
+    parser.add_argument('--enable-profiler', action='store_true',
+                        help='Serve a sampling profile of the collector at /debug/profile?seconds=N (localhost only)')
+    parser.add_argument('--url-keep-params', default='',
+                        help='Comma-separated query parameters kept in top URL labels (default: strip all)')
+    parser.add_argument('--raw-urls', action='store_true',
+                        help='Do not collapse numeric/hash path segments in top URL labels')
+    parser.add_argument('--raw-user-agents', action='store_true',
+                        help='Export raw user agent strings instead of user agent families')
+    parser.add_argument('--ua-rules', default=UA_RULES_FILE,
+                        help='User agent classification rules file (default: ua-rules.json next to this script)')
+    parser.add_argument('--ua-cache-size', type=int, default=NORMALIZE_CACHE_SIZE,
+                        help=f'Classified user agents to keep cached (default: {NORMALIZE_CACHE_SIZE})')
+    parser.add_argument('--series-budget', type=int, default=3000,
+                        help='Maximum top IP/URL/user agent series per instance, 0 for unlimited (default: 3000)')
+    parser.add_argument('--rollup-dir', default='',
+                        help='Keep per-minute rollups in this directory and serve /query (localhost only)')
+    parser.add_argument('--rollup-retention-days', type=int, default=DEFAULT_RETENTION_DAYS,
+                        help=f'Days of rollups to keep (default: {DEFAULT_RETENTION_DAYS})')
+    parser.add_argument('--counter-mode', choices=COUNTER_MODES, default='window',
+                        help='window: request/byte/status "counters" hold analysis window totals; cumulative: '
+                             'they count since the exporter started (window totals are always in sqcdy_site_window_*)')
+    parser.add_argument('--ipv4-prefix', type=int, default=24,
+                        help='Prefix length client IPv4 addresses are grouped by, 0 to disable (default: 24)')
+    parser.add_argument('--ipv6-prefix', type=int, default=48,
+                        help='Prefix length client IPv6 addresses are grouped by, 0 to disable (default: 48)')
+    parser.add_argument('--prefix-table', default='',
+                        help='Offline CSV of network,asn,provider rows used to label top prefixes')
+    parser.add_argument('--baseline-state', default=BASELINE_STATE_FILE,
+                        help=f'File the per-site anomaly baselines are saved to, empty to keep them in memory (default: {BASELINE_STATE_FILE})')
+    parser.add_argument('--sample-budget', type=int, default=0,
+                        help='Log lines per site and collection above which lines are sampled by client IP, 0 to analyze every line (default: 0)')
     args = parser.parse_args()
+    if not 0 <= args.ipv4_prefix <= 32 or not 0 <= args.ipv6_prefix <= 128:
+        parser.error('--ipv4-prefix must be 0-32 and --ipv6-prefix 0-128')
     
     # Get platform info
     platform_info = get_platform_info()
     print(f"Platform: {platform_info.get('platform')}", file=sys.stderr)
     
     # Create analyzer
-    analyzer = LogAnalyzer(platform_info, window_minutes=args.window)
+    url_normalizer = UrlNormalizer(
+        keep_params=tuple(p for p in args.url_keep_params.split(',') if p),
+        collapse_segments=not args.raw_urls
+    )
+    ua_classifier = UserAgentClassifier(load_user_agent_rules(args.ua_rules), cache_size=args.ua_cache_size)
+    rollup_store = RollupStore(args.rollup_dir, args.rollup_retention_days) if args.rollup_dir else None
+    prefix_table = None
+    if args.prefix_table:
+        prefix_table = PrefixTable(load_prefix_table(args.prefix_table))
+        print(f"Loaded {len(prefix_table)} networks from {args.prefix_table}", file=sys.stderr)
+    analyzer = LogAnalyzer(platform_info, window_minutes=args.window, url_normalizer=url_normalizer,
+                           ua_families=not args.raw_user_agents, series_budget=args.series_budget,
+                           ua_classifier=ua_classifier, rollup_store=rollup_store, counter_mode=args.counter_mode,
+                           ipv4_prefix=args.ipv4_prefix, ipv6_prefix=args.ipv6_prefix, prefix_table=prefix_table,
+                           baselines=SiteBaselines(args.baseline_state or None), sample_budget=args.sample_budget)
     
     if args.test:
         # Test mode
-        print(analyzer.collect_metrics())
+        sys.stdout.buffer.write(analyzer.collect_metrics().render())
         sys.exit(0)
     
     # Start HTTP server
     MetricsHandler.analyzer = analyzer
+    MetricsHandler.rollup_store = rollup_store
     
     # Start with empty metrics - will be populated by background thread
-    MetricsHandler.cached_metrics = "# Metrics collection in progress...\n"
+    MetricsHandler.cached_metrics = MetricRegistry()
     MetricsHandler.last_update = 0
     print("Starting HTTP server (metrics will be available shortly)...", file=sys.stderr, flush=True)
     
@@ -438,6 +1352,13 @@ def main():
     cache_thread = threading.Thread(target=MetricsHandler.update_metrics_cache, daemon=True)
     cache_thread.start()
     print("Background metrics updater started", file=sys.stderr, flush=True)
+
+    if args.enable_profiler:
+        MetricsHandler.profiler = SamplingProfiler()
+        MetricsHandler.profiler.thread_ident = cache_thread.ident
+        print(f"Profiler available at http://localhost:{args.port}/debug/profile?seconds=10", file=sys.stderr, flush=True)
+    if rollup_store:
+        print(f"Rollup queries available at http://localhost:{args.port}/query?domain=DOMAIN&from=TIME&to=TIME", file=sys.stderr, flush=True)
     
     server = ThreadingHTTPServer(('', args.port), MetricsHandler)
     
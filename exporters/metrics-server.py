@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Square Candy Command Metrics Server
+Serves the output of a shell collector (user-metrics.sh, swap-metrics.sh)
+as a Prometheus endpoint. The collector runs on demand when a scrape arrives
+and its output is cached for a short TTL, so concurrent scrapers share one run.
+"""
+
+import os
+import sys
+import time
+import threading
+import subprocess
+from subprocess import PIPE
+from typing import List, Optional
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from exporter_stats import ExporterStats
+
+
+class CommandCollector:
+    """Runs a collector command and caches its output for `ttl` seconds"""
+
+    def __init__(self, command: List[str], name: str, ttl: float = 10, timeout: float = 30):
+        self.command = command
+        self.ttl = ttl
+        self.timeout = timeout
+        self.cached: Optional[bytes] = None
+        self.cached_at = 0.0
+        # Held while the command runs: a second scraper waits for the
+        # in-flight run instead of starting another one
+        self.lock = threading.Lock()
+        self.stats = ExporterStats(name)
+
+    def get(self) -> bytes:
+        """Return collector output, re-running the command if the cache is stale"""
+        with self.lock:
+            now = time.monotonic()
+            if self.cached is None or (now - self.cached_at) >= self.ttl:
+                self._run(now)
+            return self.cached + self.stats.render()
+
+    def _run(self, now: float):
+        self.stats.start_collection()
+        try:
+            with self.stats.phase('collect'):
+                result = subprocess.run(
+                    self.command,
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    timeout=self.timeout
+                )
+            if result.returncode != 0:
+                raise RuntimeError(f"exit code {result.returncode}: {result.stderr.decode('utf-8', 'replace').strip()}")
+        except Exception as e:
+            self.stats.finish_collection(time.monotonic() - now, success=False)
+            print(f"Error running collector {self.stats.exporter}: {e}", file=sys.stderr, flush=True)
+            # Serve the previous result rather than failing the scrape
+            if self.cached is None:
+                raise
+            return
+
+        self.stats.finish_collection(time.monotonic() - now)
+        self.cached = result.stdout
+        self.cached_at = now
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """HTTP handler for Prometheus metrics endpoint"""
+
+    # HTTP/1.1 keeps scraper connections alive between requests
+    protocol_version = 'HTTP/1.1'
+    collector = None
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            try:
+                body = self.collector.get()
+            except Exception as e:
+                self.send_error(500, f"Error collecting metrics: {e}")
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        # Suppress default logging
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Square Candy Command Metrics Server')
+    parser.add_argument('--port', type=int, required=True, help='Port to listen on')
+    parser.add_argument('--name', help='Exporter name for self-metrics (default: collector file name)')
+    parser.add_argument('--ttl', type=float, default=10, help='Seconds to cache collector output (default: 10)')
+    parser.add_argument('--timeout', type=float, default=30, help='Collector command timeout in seconds (default: 30)')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='Collector command, after --')
+    args = parser.parse_args()
+
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        parser.error('a collector command is required')
+
+    script = next((arg for arg in reversed(command) if not arg.startswith('-')), command[0])
+    name = args.name or os.path.splitext(os.path.basename(script))[0]
+    MetricsHandler.collector = CommandCollector(command, name, ttl=args.ttl, timeout=args.timeout)
+
+    server = ThreadingHTTPServer(('', args.port), MetricsHandler)
+    server.daemon_threads = True
+
+    print(f"Serving {command[0]} on port {args.port} (cache TTL {args.ttl:g}s)", file=sys.stderr, flush=True)
+    print(f"Metrics available at http://localhost:{args.port}/metrics", file=sys.stderr, flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down...", file=sys.stderr)
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
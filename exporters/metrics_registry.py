@@ -0,0 +1,107 @@
+"""
+Square Candy Metric Registry
+Shared by the Python exporters to build a scrape: metric families are kept
+in a dict keyed by name, samples carry label value tuples, and the whole
+registry renders in one pass into a bytes buffer as either the Prometheus
+text format or OpenMetrics.
+"""
+
+import math
+from typing import Dict, List, Optional, Tuple
+
+CONTENT_TYPE_TEXT = 'text/plain; version=0.0.4; charset=utf-8'
+CONTENT_TYPE_OPENMETRICS = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# OpenMetrics has no "untyped"; a counter whose name lacks the _total suffix
+# would have its samples renamed, so those are exposed as unknown instead
+OPENMETRICS_TYPES = {'untyped': 'unknown'}
+
+
+def escape_label(value) -> str:
+    """Escape a label value for the Prometheus text format"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def escape_help(text: str) -> str:
+    """Escape HELP text (quotes are left alone in the text format)"""
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def format_value(value) -> str:
+    """Format a sample value without losing precision on large counters"""
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if not value.is_integer():
+            return repr(value)
+    return str(int(value))
+
+
+def wants_openmetrics(accept: Optional[str]) -> bool:
+    """True when a scraper's Accept header asks for OpenMetrics"""
+    return bool(accept) and 'application/openmetrics-text' in accept
+
+
+class MetricFamily:
+    """One metric name with its HELP/TYPE and samples"""
+
+    __slots__ = ('name', 'help', 'type', 'label_names', 'samples')
+
+    def __init__(self, name: str, help_text: str, metric_type: str = 'gauge', label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.type = metric_type
+        self.label_names = tuple(label_names)
+        # (name suffix, label values, extra (name, value) label pairs, value)
+        self.samples: List[Tuple[str, Tuple, Tuple, float]] = []
+
+    def add(self, value: float, *label_values, suffix: str = '', extra_labels: Tuple[Tuple[str, str], ...] = ()):
+        """Add a sample; label values follow the family's label names in order.
+
+        suffix and extra_labels are for histogram series (_bucket with le=...).
+        """
+        self.samples.append((suffix, label_values, extra_labels, value))
+
+    def render_into(self, out: bytearray, openmetrics: bool = False):
+        metric_type = self.type
+        if openmetrics:
+            metric_type = OPENMETRICS_TYPES.get(metric_type, metric_type)
+            if metric_type == 'counter' and not self.name.endswith('_total'):
+                metric_type = 'unknown'
+        # OpenMetrics names a counter family without its _total suffix
+        family_name = self.name[:-6] if openmetrics and metric_type == 'counter' else self.name
+        out += f'# HELP {family_name} {escape_help(self.help)}\n# TYPE {family_name} {metric_type}\n'.encode('utf-8')
+
+        label_names = self.label_names
+        for suffix, label_values, extra_labels, value in self.samples:
+            pairs = [f'{k}="{escape_label(v)}"' for k, v in zip(label_names, label_values)]
+            pairs.extend(f'{k}="{escape_label(v)}"' for k, v in extra_labels)
+            labels = '{' + ','.join(pairs) + '}' if pairs else ''
+            out += f'{self.name}{suffix}{labels} {format_value(value)}\n'.encode('utf-8')
+
+
+class MetricRegistry:
+    """Metric families for one scrape, rendered in registration order"""
+
+    def __init__(self):
+        self.families: Dict[str, MetricFamily] = {}
+
+    def family(self, name: str, help_text: str, metric_type: str = 'gauge',
+               label_names: Tuple[str, ...] = ()) -> MetricFamily:
+        """Return the family called `name`, creating it on first use"""
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = MetricFamily(name, help_text, metric_type, label_names)
+        elif family.type != metric_type or family.label_names != tuple(label_names):
+            raise ValueError(f"Metric {name} re-registered with a different type or labels")
+        return family
+
+    def render(self, openmetrics: bool = False) -> bytes:
+        out = bytearray()
+        for family in self.families.values():
+            family.render_into(out, openmetrics)
+        if openmetrics:
+            out += b'# EOF\n'
+        return bytes(out)
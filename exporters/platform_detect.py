@@ -0,0 +1,170 @@
+"""
+Square Candy Platform Detection
+In-process equivalent of `platform-detect.sh --json` for the Python exporters.
+The result is cached in a file keyed on the mtimes of the marker files the
+detection looks at, so a restart reuses it instead of probing again.
+Set SQCDY_PLATFORM to skip detection and force a platform.
+"""
+
+import os
+import sys
+import json
+import shutil
+from typing import Dict, Optional
+
+CACHE_FILE = os.environ.get('SQCDY_PLATFORM_CACHE', '/var/cache/squarecandy-monitoring/platform.json')
+CACHE_VERSION = 1
+
+PLESK_VERSION_FILE = '/usr/local/psa/version'
+GRIDPANE_CLI = '/usr/local/bin/gp'
+OS_RELEASE = '/etc/os-release'
+NGINX_CONF = '/etc/nginx/nginx.conf'
+LSB_RELEASE = '/etc/lsb-release'
+SITES_ROOT = '/var/www/sites'
+
+# Files and directories whose presence or mtime can change the result
+MARKER_PATHS = (PLESK_VERSION_FILE, GRIDPANE_CLI, OS_RELEASE, NGINX_CONF, LSB_RELEASE, '/var/www', SITES_ROOT)
+# Commands probed with `command -v` in platform-detect.sh
+MARKER_COMMANDS = ('plesk', 'nginx', 'apache2', 'httpd')
+
+PLATFORM_DEFAULTS = {
+    'plesk': {'site_path': '/var/www/vhosts', 'log_path': '/var/www/vhosts/system', 'user_pattern': 'psacln'},
+    'gridpane': {'site_path': '/var/www', 'log_path': '/var/log/nginx', 'user_pattern': 'www-data|[a-z0-9]+'},
+    'ubuntu-nginx': {'site_path': '/var/www', 'log_path': '/var/log/nginx', 'user_pattern': 'www-data'},
+}
+
+
+def _read_first_line(path: str) -> str:
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return ''
+
+
+def _has_site_logs_dir(root: str = SITES_ROOT) -> bool:
+    """True if any ROOT/USER/DOMAIN/logs directory exists; stops at the first one"""
+    try:
+        with os.scandir(root) as users:
+            for user in users:
+                if not user.is_dir():
+                    continue
+                try:
+                    with os.scandir(user.path) as domains:
+                        for domain in domains:
+                            if domain.is_dir() and os.path.isdir(os.path.join(domain.path, 'logs')):
+                                return True
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return False
+
+
+def _detect_platform() -> str:
+    if os.path.isfile(PLESK_VERSION_FILE) or shutil.which('plesk'):
+        return 'plesk'
+    if os.path.isdir('/var/www'):
+        if os.path.isfile(GRIDPANE_CLI):
+            return 'gridpane'
+        try:
+            with open(OS_RELEASE) as f:
+                if 'gridpane' in f.read().lower():
+                    return 'gridpane'
+        except OSError:
+            pass
+    if os.path.isfile(NGINX_CONF) and os.path.isfile(LSB_RELEASE):
+        return 'ubuntu-nginx'
+    return 'unknown'
+
+
+def _detect_web_server() -> str:
+    if shutil.which('nginx'):
+        return 'nginx'
+    if shutil.which('apache2') or shutil.which('httpd'):
+        return 'apache'
+    return 'unknown'
+
+
+def _platform_version(platform: str) -> str:
+    if platform == 'plesk':
+        return _read_first_line(PLESK_VERSION_FILE)
+    if platform == 'ubuntu-nginx':
+        try:
+            with open(LSB_RELEASE) as f:
+                for line in f:
+                    if line.startswith('DISTRIB_RELEASE='):
+                        return line.split('=', 1)[1].strip()
+        except OSError:
+            pass
+        return 'unknown'
+    return ''
+
+
+def detect(platform: Optional[str] = None) -> Dict[str, str]:
+    """Run detection (or fill in a forced platform), without the cache"""
+    platform = platform or _detect_platform()
+    info = {
+        'platform': platform,
+        'platform_version': _platform_version(platform),
+        'web_server': _detect_web_server(),
+        'site_path': '',
+        'log_path': '',
+        'user_pattern': '',
+    }
+    info.update(PLATFORM_DEFAULTS.get(platform, {}))
+    if platform == 'ubuntu-nginx' and _has_site_logs_dir():
+        # Custom /var/www/sites/USER/DOMAIN/logs structure
+        info['log_path'] = SITES_ROOT
+    return info
+
+
+def fingerprint() -> Dict[str, Optional[float]]:
+    """Mtimes of the marker files (None when missing) and resolved commands"""
+    result: Dict[str, Optional[float]] = {}
+    for path in MARKER_PATHS:
+        try:
+            result[path] = os.stat(path).st_mtime
+        except OSError:
+            result[path] = None
+    for command in MARKER_COMMANDS:
+        result[f'command:{command}'] = shutil.which(command)
+    result['env:SQCDY_PLATFORM'] = os.environ.get('SQCDY_PLATFORM') or None
+    return result
+
+
+def get_platform_info(cache_file: str = CACHE_FILE, use_cache: bool = True) -> Dict[str, str]:
+    """Platform info as printed by `platform-detect.sh --json`, cached on disk"""
+    key = fingerprint()
+
+    if use_cache:
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached.get('version') == CACHE_VERSION and cached.get('fingerprint') == key:
+                return cached['info']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    info = detect(os.environ.get('SQCDY_PLATFORM') or None)
+
+    if use_cache:
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp_path = f'{cache_file}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': CACHE_VERSION, 'fingerprint': key, 'info': info}, f)
+            os.replace(tmp_path, cache_file)
+        except OSError as e:
+            print(f"Could not write platform cache {cache_file}: {e}", file=sys.stderr)
+
+    return info
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Square Candy Platform Detection')
+    parser.add_argument('--no-cache', action='store_true', help='Detect again and do not touch the cache file')
+    args = parser.parse_args()
+    print(json.dumps(get_platform_info(use_cache=not args.no_cache), indent=2))
@@ -0,0 +1,351 @@
+"""
+Square Candy Rollup Store
+Per-minute, per-domain traffic rollups kept on local disk so the log
+analyzer can answer top-N questions over ranges far beyond its analysis
+window.
+
+Records are appended to one file per UTC day (rollup-YYYYMMDD.log). Once a
+day is over it is compacted into rollup-YYYYMMDD.dat: one record per
+(domain, minute), last write wins, sorted by domain and minute, with a
+domain index at the end. Both are read through mmap. Files older than the
+retention limit are deleted.
+
+File layout:
+    header   <4sHH   magic b'SQRU', format version, flags (1 = compacted)
+    record   <IIqH   payload length, crc32(payload), minute (unix seconds), domain length
+             domain (utf-8), payload (zlib-compressed JSON)
+    footer   <Q4s    index offset, magic (compacted files only; index is JSON
+                     {domain: [first record offset, end offset]})
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import zlib
+import struct
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+from sampling_profiler import LOCAL_ADDRESSES
+
+MAGIC = b'SQRU'
+VERSION = 1
+FLAG_COMPACTED = 1
+FILE_HEADER = struct.Struct('<4sHH')
+RECORD_HEADER = struct.Struct('<IIqH')
+FOOTER = struct.Struct('<Q4s')
+
+# Heavy hitters kept per minute; merged ranges are therefore lower bounds
+ROLLUP_TOP_N = 20
+DEFAULT_RETENTION_DAYS = 14
+COMPACT_INTERVAL = 3600
+MAX_QUERY_TOP = 100
+
+
+def day_of(minute: int) -> str:
+    return datetime.fromtimestamp(minute, timezone.utc).strftime('%Y%m%d')
+
+
+def new_rollup() -> Dict:
+    return {'requests': 0, 'bytes': 0, 'status': Counter(), 'ips': Counter(), 'urls': Counter()}
+
+
+def encode_payload(rollup: Dict, top_n: int = ROLLUP_TOP_N) -> bytes:
+    data = {
+        'r': rollup['requests'],
+        'b': rollup['bytes'],
+        's': dict(rollup['status']),
+        'i': rollup['ips'].most_common(top_n),
+        'u': rollup['urls'].most_common(top_n),
+    }
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'), 1)
+
+
+def iter_records(buf, start: int, end: int) -> Iterator[Tuple[int, int, str, int, int]]:
+    """Yield (record offset, minute, domain, payload start, payload end) until end or a bad record"""
+    offset = start
+    while offset + RECORD_HEADER.size <= end:
+        length, crc, minute, domain_length = RECORD_HEADER.unpack_from(buf, offset)
+        payload_start = offset + RECORD_HEADER.size + domain_length
+        payload_end = payload_start + length
+        if payload_end > end or zlib.crc32(buf[payload_start:payload_end]) != crc:
+            # Torn write at the end of an append-only file
+            return
+        domain = bytes(buf[offset + RECORD_HEADER.size:payload_start]).decode('utf-8', 'replace')
+        yield offset, minute, domain, payload_start, payload_end
+        offset = payload_end
+
+
+def open_mmap(path: str):
+    """Read-only mmap of a file, or None if it is missing or empty"""
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+
+class RollupStore:
+    """Append-only per-minute rollups with daily compaction and retention"""
+
+    def __init__(self, directory: str, retention_days: int = DEFAULT_RETENTION_DAYS, top_n: int = ROLLUP_TOP_N):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.top_n = top_n
+        self.lock = threading.Lock()
+        # Offsets of each domain's records in the uncompacted day files:
+        # path -> (indexed size, {domain: [offsets]})
+        self.log_index: Dict[str, Tuple[int, Dict[str, List[int]]]] = {}
+        self.last_compaction = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, day: str, compacted: bool) -> str:
+        return os.path.join(self.directory, f"rollup-{day}.{'dat' if compacted else 'log'}")
+
+    # Writing
+
+    def append(self, domain: str, rollups: Dict[int, Dict]):
+        """Persist a domain's rollups, keyed by minute (unix seconds)"""
+        by_day = defaultdict(list)
+        for minute, rollup in sorted(rollups.items()):
+            by_day[day_of(minute)].append((minute, rollup))
+
+        with self.lock:
+            for day, records in by_day.items():
+                path = self.path(day, compacted=False)
+                offsets = self._index_log(path)
+                with open(path, 'ab') as f:
+                    if f.tell() == 0:
+                        f.write(FILE_HEADER.pack(MAGIC, VERSION, 0))
+                    offset = f.tell()
+                    chunk = bytearray()
+                    domain_bytes = domain.encode('utf-8')
+                    for minute, rollup in records:
+                        payload = encode_payload(rollup, self.top_n)
+                        offsets.setdefault(domain, []).append(offset + len(chunk))
+                        chunk += RECORD_HEADER.pack(len(payload), zlib.crc32(payload), minute, len(domain_bytes))
+                        chunk += domain_bytes
+                        chunk += payload
+                    f.write(chunk)
+                    size = f.tell()
+                self.log_index[path] = (size, offsets)
+
+    def _index_log(self, path: str) -> Dict[str, List[int]]:
+        """Domain -> record offsets for an uncompacted file, truncating a torn tail"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            self.log_index.pop(path, None)
+            return {}
+        cached = self.log_index.get(path)
+        if cached and cached[0] == size:
+            return cached[1]
+
+        offsets: Dict[str, List[int]] = {}
+        good_end = FILE_HEADER.size
+        buf = open_mmap(path)
+        if buf is not None:
+            with buf:
+                for offset, _, domain, _, payload_end in iter_records(buf, FILE_HEADER.size, len(buf)):
+                    offsets.setdefault(domain, []).append(offset)
+                    good_end = payload_end
+        if size > good_end:
+            # Drop a partially written record so appends stay readable
+            with open(path, 'r+b') as f:
+                f.truncate(good_end)
+            size = good_end
+        self.log_index[path] = (size, offsets)
+        return offsets
+
+    # Compaction
+
+    def maintain(self, now: Optional[float] = None):
+        """Compact finished days and apply retention, at most once per COMPACT_INTERVAL"""
+        now = now or time.time()
+        if now - self.last_compaction < COMPACT_INTERVAL:
+            return
+        self.last_compaction = now
+        today = day_of(int(now))
+        oldest = (datetime.fromtimestamp(now, timezone.utc) - timedelta(days=self.retention_days)).strftime('%Y%m%d')
+
+        with self.lock:
+            try:
+                names = sorted(os.listdir(self.directory))
+            except OSError as e:
+                print(f"Error listing rollups in {self.directory}: {e}", file=sys.stderr)
+                return
+            for name in names:
+                if not name.startswith('rollup-') or name.endswith('.tmp'):
+                    continue
+                day, _, ext = name[len('rollup-'):].partition('.')
+                path = os.path.join(self.directory, name)
+                if day < oldest:
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        print(f"Error removing expired rollups {path}: {e}", file=sys.stderr)
+                        continue
+                    self.log_index.pop(path, None)
+                elif ext == 'log' and day < today:
+                    try:
+                        self._compact(day)
+                    except OSError as e:
+                        print(f"Error compacting rollups for {day}: {e}", file=sys.stderr)
+
+    def _compact(self, day: str):
+        """Merge a day's .dat and .log into a new .dat, last write per (domain, minute) wins"""
+        latest: Dict[Tuple[str, int], bytes] = {}
+        for compacted in (True, False):
+            buf = open_mmap(self.path(day, compacted))
+            if buf is None:
+                continue
+            with buf:
+                for _, minute, domain, start, end in iter_records(buf, FILE_HEADER.size, len(buf)):
+                    latest[(domain, minute)] = bytes(buf[start:end])
+
+        out = bytearray(FILE_HEADER.pack(MAGIC, VERSION, FLAG_COMPACTED))
+        index: Dict[str, List[int]] = {}
+        for (domain, minute), payload in sorted(latest.items()):
+            domain_bytes = domain.encode('utf-8')
+            if domain not in index:
+                index[domain] = [len(out), len(out)]
+            out += RECORD_HEADER.pack(len(payload), zlib.crc32(payload), minute, len(domain_bytes))
+            out += domain_bytes
+            out += payload
+            index[domain][1] = len(out)
+        index_offset = len(out)
+        out += json.dumps(index, separators=(',', ':')).encode('utf-8')
+        out += FOOTER.pack(index_offset, MAGIC)
+
+        target = self.path(day, compacted=True)
+        tmp_path = f'{target}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(out)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, target)
+        log_path = self.path(day, compacted=False)
+        os.remove(log_path)
+        self.log_index.pop(log_path, None)
+
+    # Querying
+
+    def query(self, domain: str, start: int, end: int, top: int = 10) -> Dict:
+        """Merge the rollups of [start, end) for one domain"""
+        minutes: Dict[int, bytes] = {}
+        day = datetime.fromtimestamp(start, timezone.utc).date()
+        last_day = datetime.fromtimestamp(max(start, end - 1), timezone.utc).date()
+        with self.lock:
+            while day <= last_day:
+                name = day.strftime('%Y%m%d')
+                self._read_compacted(self.path(name, True), domain, start, end, minutes)
+                self._read_log(self.path(name, False), domain, start, end, minutes)
+                day += timedelta(days=1)
+
+        result = new_rollup()
+        for payload in minutes.values():
+            data = json.loads(zlib.decompress(payload))
+            result['requests'] += data['r']
+            result['bytes'] += data['b']
+            result['status'].update(data['s'])
+            result['ips'].update(dict(data['i']))
+            result['urls'].update(dict(data['u']))
+
+        return {
+            'domain': domain,
+            'from': start,
+            'to': end,
+            'minutes': len(minutes),
+            'requests': result['requests'],
+            'bytes': result['bytes'],
+            'status_codes': dict(result['status']),
+            'top_ips': result['ips'].most_common(top),
+            'top_urls': result['urls'].most_common(top),
+            # Heavy hitters are truncated per minute, so merged counts are lower bounds
+            'per_minute_top_n': self.top_n,
+        }
+
+    @staticmethod
+    def _read_compacted(path: str, domain: str, start: int, end: int, minutes: Dict[int, bytes]):
+        buf = open_mmap(path)
+        if buf is None:
+            return
+        with buf:
+            if len(buf) < FILE_HEADER.size + FOOTER.size:
+                return
+            index_offset, magic = FOOTER.unpack_from(buf, len(buf) - FOOTER.size)
+            if magic != MAGIC:
+                return
+            index = json.loads(bytes(buf[index_offset:len(buf) - FOOTER.size]))
+            span = index.get(domain)
+            if not span:
+                return
+            for _, minute, _, payload_start, payload_end in iter_records(buf, span[0], span[1]):
+                if start <= minute < end:
+                    minutes[minute] = bytes(buf[payload_start:payload_end])
+
+    def _read_log(self, path: str, domain: str, start: int, end: int, minutes: Dict[int, bytes]):
+        offsets = self._index_log(path).get(domain)
+        if not offsets:
+            return
+        buf = open_mmap(path)
+        if buf is None:
+            return
+        with buf:
+            for offset in offsets:
+                for _, minute, _, payload_start, payload_end in iter_records(buf, offset, len(buf)):
+                    if start <= minute < end:
+                        minutes[minute] = bytes(buf[payload_start:payload_end])
+                    break
+
+
+def parse_time_arg(value: str) -> int:
+    """Unix seconds, or an ISO 8601 time (UTC unless it carries an offset)"""
+    try:
+        return int(float(value))
+    except ValueError:
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return int(parsed.timestamp())
+
+
+def handle_query_request(handler, store: RollupStore):
+    """Serve GET /query?domain=&from=&to=&top= from a BaseHTTPRequestHandler"""
+    if handler.client_address[0] not in LOCAL_ADDRESSES:
+        handler.send_error(403, "Queries are only available from localhost")
+        return
+
+    query = parse_qs(urlsplit(handler.path).query)
+    domain = query.get('domain', [''])[0]
+    if not domain:
+        handler.send_error(400, "domain is required")
+        return
+    try:
+        end = parse_time_arg(query['to'][0]) if 'to' in query else int(time.time())
+        start = parse_time_arg(query['from'][0]) if 'from' in query else end - 3600
+        top = min(max(int(query.get('top', ['10'])[0]), 1), MAX_QUERY_TOP)
+    except ValueError:
+        handler.send_error(400, "from/to must be unix seconds or ISO 8601, top a number")
+        return
+    if end <= start:
+        handler.send_error(400, "to must be after from")
+        return
+
+    started = time.perf_counter()
+    result = store.query(domain, start - start % 60, end, top)
+    result['query_seconds'] = round(time.perf_counter() - started, 6)
+    body = json.dumps(result).encode('utf-8')
+
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'application/json')
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
@@ -0,0 +1,86 @@
+"""
+Square Candy Sampling Profiler
+Opt-in /debug/profile?seconds=N endpoint for the Python exporters.
+Samples the collector thread's stack with sys._current_frames() at a fixed
+rate and returns collapsed stacks ("frame;frame;frame count"), the input
+format of flamegraph.pl and speedscope. Nothing runs while no profile is
+being taken.
+"""
+
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+
+# Sampling interval in seconds (100 Hz)
+SAMPLE_INTERVAL = 0.01
+DEFAULT_SECONDS = 10
+MAX_SECONDS = 60
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1', '::ffff:127.0.0.1')
+
+
+def collapse_stack(frame) -> str:
+    """Render a frame and its callers root-first as file:function:line;..."""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
+
+
+class SamplingProfiler:
+    """Samples one thread's stack on demand"""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.thread_ident = None
+        # Only one profile at a time; a second request is refused, not queued
+        self.lock = threading.Lock()
+
+    def profile(self, seconds: float) -> str:
+        """Sample the target thread for `seconds` and return collapsed stacks"""
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_ident)
+            if frame is not None:
+                stacks[collapse_stack(frame)] += 1
+            time.sleep(self.interval)
+
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def handle_profile_request(handler, profiler: SamplingProfiler):
+    """Serve GET /debug/profile?seconds=N from a BaseHTTPRequestHandler"""
+    if handler.client_address[0] not in LOCAL_ADDRESSES:
+        handler.send_error(403, "Profiling is only available from localhost")
+        return
+
+    query = parse_qs(urlsplit(handler.path).query)
+    try:
+        seconds = float(query.get('seconds', [DEFAULT_SECONDS])[0])
+    except ValueError:
+        handler.send_error(400, "seconds must be a number")
+        return
+    seconds = min(max(seconds, 0.1), MAX_SECONDS)
+
+    if profiler.thread_ident is None:
+        handler.send_error(503, "Collector thread not started")
+        return
+    if not profiler.lock.acquire(blocking=False):
+        handler.send_error(409, "A profile is already running")
+        return
+    try:
+        body = profiler.profile(seconds).encode('utf-8')
+    finally:
+        profiler.lock.release()
+
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'text/plain; charset=utf-8')
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
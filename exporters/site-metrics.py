@@ -6,47 +6,304 @@ Supports: Plesk, GridPane, Ubuntu Custom
 """
 
 import os
+import re
 import sys
-import json
+import pwd
+import shutil
 import subprocess
 from subprocess import PIPE
 import time
 import threading
 from pathlib import Path
-from typing import Dict, List, Optional
+from collections import defaultdict
+from fnmatch import fnmatchcase
+from typing import Dict, List, Optional, Tuple
 from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
 import argparse
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from exporter_stats import ExporterStats
+from platform_detect import get_platform_info
+from vhost_config import VhostConfig
+from metrics_registry import MetricRegistry, CONTENT_TYPE_OPENMETRICS, CONTENT_TYPE_TEXT, wants_openmetrics
+from sampling_profiler import SamplingProfiler, handle_profile_request
+
 # Cache for site list (refresh every 5 minutes)
 SITE_CACHE = None
 SITE_CACHE_TIME = 0
 SITE_CACHE_TTL = 300  # 5 minutes
 
-# Cache for metrics (refresh every 2 minutes in background)
-METRICS_CACHE = None
+# Cache for the last collected registry (refresh every 2 minutes in background)
+METRICS_CACHE: Optional[MetricRegistry] = None
 METRICS_CACHE_LOCK = threading.Lock()
 
-# Prometheus exposition format
-class PrometheusMetrics:
+# Parsed nginx/Apache vhosts, re-read only when a config file changes
+VHOST_CONFIG = VhostConfig()
+
+# Self-instrumentation (collection timings, per-site scan time)
+STATS = ExporterStats('site-metrics')
+STATS.describe('sqcdy_site_disk_scan_seconds', 'Time spent measuring site disk usage in the last collection',
+               ('domain',), metric_type='gauge')
+
+# /proc/PID/stat reports CPU time in clock ticks and RSS in pages
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+# Directory mtimes this close to the scan time are not trusted as cache keys
+RACY_MTIME_NS = 2_000_000_000
+
+
+class BackupTracker:
+    """Newest backup per backup directory, rescanned only when the directory changes
+
+    Adding, removing or renaming a backup updates its directory's mtime, so
+    a collection normally costs one stat per directory plus one for the
+    newest backup (to pick up a dump that is still being written).
+    """
+
     def __init__(self):
-        self.metrics = []
-    
-    def add_metric(self, name: str, value: float, labels: Dict[str, str] = None, help_text: str = None, metric_type: str = "gauge"):
-        """Add a metric in Prometheus format"""
-        if help_text and not any(m.startswith(f'# HELP {name}') for m in self.metrics):
-            self.metrics.append(f'# HELP {name} {help_text}')
-            self.metrics.append(f'# TYPE {name} {metric_type}')
-        
-        label_str = ""
-        if labels:
-            label_pairs = [f'{k}="{v}"' for k, v in labels.items()]
-            label_str = "{" + ",".join(label_pairs) + "}"
-        
-        self.metrics.append(f'{name}{label_str} {value}')
-    
-    def render(self) -> str:
-        """Render all metrics as Prometheus exposition format"""
-        return "\n".join(self.metrics) + "\n"
+        # (directory, pattern) -> (directory mtime, newest path, newest mtime, newest size)
+        self.index: Dict[Tuple[str, str], Tuple[int, Optional[str], float, int]] = {}
+
+    def newest(self, locations: List[Tuple[str, str]]) -> Optional[Tuple[int, int]]:
+        """(timestamp, size) of the newest backup across locations, or None"""
+        best = None
+        for directory, pattern in locations:
+            found = self._newest_in(directory, pattern)
+            if found and (best is None or found[0] > best[0]):
+                best = found
+        return best
+
+    def _newest_in(self, directory: str, pattern: str) -> Optional[Tuple[int, int]]:
+        key = (directory, pattern)
+        try:
+            dir_mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            self.index.pop(key, None)
+            return None
+
+        cached = self.index.get(key)
+        if cached is None or cached[0] != dir_mtime:
+            newest_path, newest_mtime = None, 0.0
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if not fnmatchcase(entry.name, pattern):
+                            continue
+                        try:
+                            mtime = entry.stat().st_mtime
+                        except OSError:
+                            continue
+                        if newest_path is None or mtime > newest_mtime:
+                            newest_path, newest_mtime = entry.path, mtime
+            except OSError:
+                return None
+            if time.time_ns() - dir_mtime < RACY_MTIME_NS:
+                # Timestamps are coarse: a change in the same tick as this scan
+                # would not move the mtime, so rescan next time
+                dir_mtime = -1
+            cached = (dir_mtime, newest_path, -1.0, 0)
+
+        _, newest_path, known_mtime, size = cached
+        if newest_path is None:
+            self.index[key] = cached
+            return None
+        try:
+            st = os.stat(newest_path)
+        except OSError:
+            self.index.pop(key, None)
+            return None
+        if st.st_mtime != known_mtime:
+            size = self._backup_size(newest_path, st)
+        self.index[key] = (dir_mtime, newest_path, st.st_mtime, size)
+        return int(st.st_mtime), size
+
+    @staticmethod
+    def _backup_size(path: str, st: os.stat_result) -> int:
+        """File size, or the total of the files directly inside a backup directory"""
+        if not os.path.isdir(path):
+            return st.st_size
+        total = 0
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+        return total
+
+
+BACKUP_TRACKER = BackupTracker()
+
+# repquota option per quota type: user quotas and XFS/ext4 project quotas
+QUOTA_TYPES = (('user', '-u'), ('project', '-P'))
+PROJECTS_FILE = '/etc/projects'
+REPQUOTA_FLAGS = ('--', '+-', '-+', '++')
+
+
+class QuotaUsage:
+    """Site disk usage read from the kernel's quota accounting
+
+    `repquota -a -n` reports usage per user and per project on every
+    filesystem with quotas enabled, whatever the size of the trees. A site
+    uses a project quota whose /etc/projects directory is the site path, or
+    the user quota of a user that owns exactly one site on that filesystem
+    and whose home directory is inside the site or on another filesystem
+    (a user quota counts every file of the user, home included). Anything
+    else returns None, and the adapter falls back to du. Both report
+    allocated bytes.
+    """
+
+    def __init__(self):
+        self.enabled = shutil.which('repquota') is not None
+        # (quota type, filesystem st_dev, quota id) -> bytes used
+        self.usage: Dict[Tuple[str, int, int], int] = {}
+        # realpath -> project id
+        self.projects: Dict[str, int] = {}
+        # (filesystem st_dev, uid) -> number of sites owned
+        self.owned_sites: Dict[Tuple[int, int], int] = defaultdict(int)
+        self.uids: Dict[str, Optional[int]] = {}
+
+    def refresh(self, sites: List[Dict]):
+        """Re-read quota usage; called once per collection"""
+        self.usage = {}
+        self.owned_sites = defaultdict(int)
+        if not self.enabled:
+            return
+
+        devices = self._mount_devices()
+        for quota_type, option in QUOTA_TYPES:
+            try:
+                result = subprocess.run(
+                    ['repquota', '-a', '-n', option],
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    text=True,
+                    timeout=30
+                )
+            except Exception as e:
+                print(f"Error running repquota {option}: {e}", file=sys.stderr)
+                continue
+            self._parse_repquota(quota_type, result.stdout, devices)
+
+        self.projects = self._read_projects() if any(key[0] == 'project' for key in self.usage) else {}
+
+        for site in sites:
+            uid = self._uid(site.get('user', ''))
+            dev = self._dev(site.get('path', ''))
+            if uid is not None and dev is not None:
+                self.owned_sites[(dev, uid)] += 1
+
+    def site_usage(self, site: Dict) -> Optional[int]:
+        """Bytes used by the site according to quotas, or None if no quota covers it"""
+        if not self.usage:
+            return None
+        path = site.get('path', '')
+        dev = self._dev(path)
+        if dev is None:
+            return None
+
+        project = self.projects.get(os.path.realpath(path))
+        if project is not None and ('project', dev, project) in self.usage:
+            return self.usage[('project', dev, project)]
+
+        uid = self._uid(site.get('user', ''))
+        if uid is not None and self.owned_sites.get((dev, uid)) == 1 and self._home_in_site(uid, dev, path):
+            return self.usage.get(('user', dev, uid))
+        return None
+
+    def _home_in_site(self, uid: int, dev: int, path: str) -> bool:
+        """Whether the user's home directory is not counted beside the site by its user quota
+
+        /var/www/sites/USER/DOMAIN layouts often keep the home directory (and
+        logs or backups) next to the site on the same filesystem.
+        """
+        try:
+            home = os.path.realpath(pwd.getpwuid(uid).pw_dir)
+        except KeyError:
+            return True
+        if self._dev(home) != dev:
+            return True
+        site = os.path.realpath(path)
+        return home == site or home.startswith(site + os.sep)
+
+    def _parse_repquota(self, quota_type: str, output: str, devices: Dict[str, int]):
+        """Parse default repquota output; with -n rows start with #ID and usage is in KiB"""
+        dev = None
+        for line in output.splitlines():
+            if line.startswith('***'):
+                # *** Report for user quotas on device /dev/sda1
+                device = line.split()[-1]
+                dev = devices.get(device, devices.get(os.path.realpath(device)))
+                continue
+            if dev is None or not line.startswith('#'):
+                continue
+            parts = line.split()
+            try:
+                quota_id = int(parts[0][1:])
+                used = parts[2] if parts[1] in REPQUOTA_FLAGS else parts[1]
+                self.usage[(quota_type, dev, quota_id)] = int(used.rstrip('K')) * 1024
+            except (IndexError, ValueError):
+                continue
+
+    @staticmethod
+    def _mount_devices() -> Dict[str, int]:
+        """Block device -> st_dev of the filesystem mounted from it"""
+        devices = {}
+        try:
+            with open('/proc/self/mounts') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) < 2 or not fields[0].startswith('/'):
+                        continue
+                    mountpoint = fields[1].replace('\\040', ' ')
+                    try:
+                        dev = os.stat(mountpoint).st_dev
+                    except OSError:
+                        continue
+                    devices.setdefault(fields[0], dev)
+                    devices.setdefault(os.path.realpath(fields[0]), dev)
+        except OSError:
+            pass
+        return devices
+
+    @staticmethod
+    def _read_projects() -> Dict[str, int]:
+        """/etc/projects lines are ID:DIRECTORY"""
+        projects = {}
+        try:
+            with open(PROJECTS_FILE) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith('#') or ':' not in line:
+                        continue
+                    project_id, path = line.split(':', 1)
+                    try:
+                        projects[os.path.realpath(path)] = int(project_id)
+                    except ValueError:
+                        continue
+        except OSError:
+            pass
+        return projects
+
+    def _uid(self, user: str) -> Optional[int]:
+        if user not in self.uids:
+            try:
+                self.uids[user] = pwd.getpwnam(user).pw_uid
+            except KeyError:
+                self.uids[user] = None
+        return self.uids[user]
+
+    @staticmethod
+    def _dev(path: str) -> Optional[int]:
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            return None
+
+
+QUOTA_USAGE = QuotaUsage()
 
 
 class PlatformAdapter:
@@ -60,18 +317,150 @@ class PlatformAdapter:
         """Return list of sites with metadata"""
         raise NotImplementedError
     
+    def prepare_disk_usage(self, sites: List[Dict]):
+        """Called once per collection before get_site_disk_usage"""
+        QUOTA_USAGE.refresh(sites)
+    
     def get_site_disk_usage(self, site: Dict) -> float:
-        """Return disk usage in bytes for a site"""
-        raise NotImplementedError
+        """Return disk usage in bytes for a site: quota accounting if available, else du"""
+        usage = QUOTA_USAGE.site_usage(site)
+        if usage is not None:
+            return float(usage)
+        return self._du_disk_usage(site)
     
-    def get_site_backup_status(self, site: Dict) -> Optional[int]:
-        """Return timestamp of last successful backup, or None"""
-        raise NotImplementedError
+    def _du_disk_usage(self, site: Dict) -> float:
+        """Get disk usage using du command"""
+        try:
+            path = site.get('path', '')
+            if not os.path.exists(path):
+                return 0.0
+            
+            result = subprocess.run(
+                # Allocated bytes, the same measure as quota accounting
+                ['du', '-s', '-B1', path],
+                stdout=PIPE,
+                stderr=PIPE,
+                text=True,
+                timeout=60
+            )
+            
+            if result.returncode == 0:
+                size_str = result.stdout.split()[0]
+                return float(size_str)
+        except Exception as e:
+            print(f"Error getting disk usage for {site.get('domain')}: {e}", file=sys.stderr)
+        
+        return 0.0
+    
+    def get_backup_locations(self, site: Dict) -> List[Tuple[str, str]]:
+        """(directory, file name pattern) pairs where the site's backups are written"""
+        return []
+    
+    def get_site_backup_status(self, site: Dict) -> Optional[Tuple[int, int]]:
+        """Return (timestamp, size in bytes) of the newest backup, or None"""
+        return BACKUP_TRACKER.newest(self.get_backup_locations(site))
+
+
+# Plesk writes one generated config per domain under system/DOMAIN/conf
+PLESK_CONF_FILES = ('httpd.conf', 'nginx.conf')
+SUEXEC_PATTERN = re.compile(r'^\s*SuexecUserGroup\s+"?([^"\s]+)"?', re.MULTILINE)
+DOCROOT_PATTERN = re.compile(r'^\s*(?:DocumentRoot|root)\s+"?([^";\s]+)"?', re.MULTILINE)
+
+
+class PleskInventory:
+    """Plesk domains and their system users, read from /var/www/vhosts
+
+    Every domain has a /var/www/vhosts/system/DOMAIN directory holding the
+    web server configs Plesk generates for it. The owning user comes from the
+    SuexecUserGroup line of httpd.conf, or the owner of the site directory on
+    nginx-only hosts. Parsed entries are kept until the domain's config files
+    change, so a steady-state refresh only stats files.
+    """
+
+    def __init__(self, vhosts_path: str = '/var/www/vhosts'):
+        self.vhosts_path = vhosts_path
+        self.system_path = os.path.join(vhosts_path, 'system')
+        # domain -> (config mtimes, site dict)
+        self.entries: Dict[str, Tuple[Tuple, Dict[str, str]]] = {}
+        self.users: Dict[int, str] = {}
+
+    def get_sites(self) -> List[Dict[str, str]]:
+        """Current sites, or an empty list if the vhosts tree is not readable"""
+        sites = []
+        entries = {}
+        try:
+            with os.scandir(self.system_path) as it:
+                domain_dirs = sorted(entry.name for entry in it if entry.is_dir() and '.' in entry.name)
+        except OSError:
+            return []
+
+        for domain in domain_dirs:
+            conf_dir = os.path.join(self.system_path, domain, 'conf')
+            key = tuple(self._mtime(os.path.join(conf_dir, name)) for name in PLESK_CONF_FILES)
+            if not any(key):
+                # Not a web domain (mail-only or being created)
+                continue
+            cached = self.entries.get(domain)
+            if cached is None or cached[0] != key:
+                cached = (key, self._read_site(domain, conf_dir))
+            entries[domain] = cached
+            sites.append(cached[1])
+
+        self.entries = entries
+        return sites
+
+    def _read_site(self, domain: str, conf_dir: str) -> Dict[str, str]:
+        user = None
+        docroot = None
+        for name in PLESK_CONF_FILES:
+            try:
+                with open(os.path.join(conf_dir, name), errors='replace') as f:
+                    config = f.read()
+            except OSError:
+                continue
+            if user is None:
+                match = SUEXEC_PATTERN.search(config)
+                user = match.group(1) if match else None
+            if docroot is None:
+                match = DOCROOT_PATTERN.search(config)
+                docroot = match.group(1) if match else None
+
+        # Subscription domains own /var/www/vhosts/DOMAIN; additional domains
+        # live inside their subscription, so fall back to the document root
+        path = os.path.join(self.vhosts_path, domain)
+        if not os.path.isdir(path) and docroot:
+            path = docroot
+        if user is None:
+            user = self.owner(path)
+        return {'domain': domain, 'path': path, 'user': user}
+
+    def owner(self, path: str) -> str:
+        try:
+            uid = os.stat(path).st_uid
+        except OSError:
+            return 'unknown'
+        if uid not in self.users:
+            try:
+                self.users[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                self.users[uid] = str(uid)
+        return self.users[uid]
+
+    @staticmethod
+    def _mtime(path: str) -> Optional[float]:
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
 
 
 class PleskAdapter(PlatformAdapter):
     """Plesk platform adapter"""
     
+    def __init__(self, platform_info: Dict):
+        super().__init__(platform_info)
+        self.inventory = PleskInventory(self.platform_info.get('site_path', '/var/www/vhosts'))
+    
     def get_sites(self) -> List[Dict[str, str]]:
         global SITE_CACHE, SITE_CACHE_TIME
         
@@ -80,6 +469,18 @@ class PleskAdapter(PlatformAdapter):
         if SITE_CACHE is not None and (current_time - SITE_CACHE_TIME) < SITE_CACHE_TTL:
             return SITE_CACHE
         
+        sites = self.inventory.get_sites()
+        if not sites:
+            sites = self._get_sites_from_cli()
+        
+        # Update cache
+        SITE_CACHE = sites
+        SITE_CACHE_TIME = current_time
+        
+        return sites
+    
+    def _get_sites_from_cli(self) -> List[Dict[str, str]]:
+        """Fallback when the vhosts tree cannot be read: ask the Plesk CLI"""
         sites = []
         try:
             # Get list of domains from Plesk CLI
@@ -99,51 +500,16 @@ class PleskAdapter(PlatformAdapter):
                 sites.append({
                     'domain': domain,
                     'path': f"{site_path}/{domain}",
-                    'user': 'plesk-user'  # Simplified - user lookup is expensive
+                    'user': self.inventory.owner(f"{site_path}/{domain}")
                 })
         except Exception as e:
             print(f"Error getting Plesk sites: {e}", file=sys.stderr)
         
-        # Update cache
-        SITE_CACHE = sites
-        SITE_CACHE_TIME = current_time
-        
         return sites
     
-    def get_site_disk_usage(self, site: Dict) -> float:
-        """Get disk usage using du command"""
-        try:
-            path = site.get('path', '')
-            if not os.path.exists(path):
-                return 0.0
-            
-            result = subprocess.run(
-                ['du', '-sb', path],
-                stdout=PIPE,
-                stderr=PIPE,
-                text=True,
-                timeout=60
-            )
-            
-            if result.returncode == 0:
-                size_str = result.stdout.split()[0]
-                return float(size_str)
-        except Exception as e:
-            print(f"Error getting disk usage for {site.get('domain')}: {e}", file=sys.stderr)
-        
-        return 0.0
-    
-    def get_site_backup_status(self, site: Dict) -> Optional[int]:
-        """Check Plesk backup status"""
-        try:
-            backup_dir = f"/var/lib/psa/dumps/domains/{site['domain']}"
-            if os.path.exists(backup_dir):
-                backups = sorted(Path(backup_dir).glob('backup_*'), key=os.path.getmtime, reverse=True)
-                if backups:
-                    return int(backups[0].stat().st_mtime)
-        except:
-            pass
-        return None
+    def get_backup_locations(self, site: Dict) -> List[Tuple[str, str]]:
+        """Plesk keeps local dumps per domain"""
+        return [(f"/var/lib/psa/dumps/domains/{site['domain']}", 'backup_*')]
 
 
 class GridPaneAdapter(PlatformAdapter):
@@ -151,7 +517,7 @@ class GridPaneAdapter(PlatformAdapter):
     
     def get_sites(self) -> List[Dict[str, str]]:
         sites = []
-        site_path = Path('/var/www')
+        site_path = Path(self.platform_info.get('site_path', '/var/www'))
         
         try:
             for site_dir in site_path.iterdir():
@@ -188,51 +554,13 @@ class GridPaneAdapter(PlatformAdapter):
         except:
             return "www-data"
     
-    def get_site_disk_usage(self, site: Dict) -> float:
-        """Get disk usage using du command"""
-        try:
-            path = site.get('path', '')
-            if not os.path.exists(path):
-                return 0.0
-            
-            result = subprocess.run(
-                ['du', '-sb', path],
-                stdout=PIPE,
-                stderr=PIPE,
-                text=True,
-                timeout=60
-            )
-            
-            if result.returncode == 0:
-                size_str = result.stdout.split()[0]
-                return float(size_str)
-        except Exception as e:
-            print(f"Error getting disk usage for {site.get('domain')}: {e}", file=sys.stderr)
-        
-        return 0.0
-    
-    def get_site_backup_status(self, site: Dict) -> Optional[int]:
+    def get_backup_locations(self, site: Dict) -> List[Tuple[str, str]]:
         """Check for backup files - GridPane specific logic"""
         # GridPane might store backups differently - adjust as needed
-        try:
-            backup_patterns = [
-                f"/var/backups/{site['domain']}*",
-                f"{site['path']}/backups/*"
-            ]
-            
-            latest_backup = None
-            for pattern in backup_patterns:
-                backups = sorted(Path(os.path.dirname(pattern)).glob(os.path.basename(pattern)), 
-                               key=lambda p: p.stat().st_mtime, reverse=True)
-                if backups:
-                    backup_time = int(backups[0].stat().st_mtime)
-                    if latest_backup is None or backup_time > latest_backup:
-                        latest_backup = backup_time
-            
-            return latest_backup
-        except:
-            pass
-        return None
+        return [
+            ('/var/backups', f"{site['domain']}*"),
+            (f"{site['path']}/backups", '*')
+        ]
 
 
 class UbuntuAdapter(PlatformAdapter):
@@ -281,61 +609,23 @@ class UbuntuAdapter(PlatformAdapter):
         return sites
     
     def _get_sites_from_config(self) -> List[Dict[str, str]]:
-        """Parse nginx/apache configs to find sites"""
-        sites = []
-        
-        # Try nginx first
-        nginx_config_dirs = ['/etc/nginx/sites-enabled', '/etc/nginx/conf.d']
-        for config_dir in nginx_config_dirs:
-            if os.path.exists(config_dir):
-                sites.extend(self._parse_nginx_configs(config_dir))
-        
-        # Try apache
-        apache_config_dirs = ['/etc/apache2/sites-enabled', '/etc/httpd/conf.d']
-        for config_dir in apache_config_dirs:
-            if os.path.exists(config_dir):
-                sites.extend(self._parse_apache_configs(config_dir))
-        
-        return sites
-    
-    def _parse_nginx_configs(self, config_dir: str) -> List[Dict[str, str]]:
-        """Parse nginx config files to extract server names and root paths"""
+        """Sites from the nginx server blocks / Apache VirtualHosts that have a document root"""
         sites = []
         try:
-            for config_file in Path(config_dir).glob('*'):
-                if config_file.is_file():
-                    with open(config_file) as f:
-                        content = f.read()
-                        # Simple regex-like parsing (could be improved)
-                        server_name = None
-                        root_path = None
-                        for line in content.split('\n'):
-                            line = line.strip()
-                            if 'server_name' in line:
-                                parts = line.split()
-                                if len(parts) >= 2:
-                                    server_name = parts[1].rstrip(';')
-                            if 'root' in line and not line.startswith('#'):
-                                parts = line.split()
-                                if len(parts) >= 2:
-                                    root_path = parts[1].rstrip(';')
-                        
-                        if server_name and root_path:
-                            sites.append({
-                                'domain': server_name,
-                                'path': root_path,
-                                'user': self._get_dir_owner(Path(root_path)) if os.path.exists(root_path) else 'www-data'
-                            })
+            for domain, vhost in VHOST_CONFIG.get_sites().items():
+                root_path = vhost['root']
+                if not root_path:
+                    continue
+                sites.append({
+                    'domain': domain,
+                    'path': root_path,
+                    'user': self._get_dir_owner(Path(root_path)) if os.path.exists(root_path) else 'www-data'
+                })
         except Exception as e:
-            print(f"Error parsing nginx configs: {e}", file=sys.stderr)
+            print(f"Error parsing vhost configs: {e}", file=sys.stderr)
         
         return sites
     
-    def _parse_apache_configs(self, config_dir: str) -> List[Dict[str, str]]:
-        """Parse apache config files"""
-        # Similar to nginx parsing - simplified for now
-        return []
-    
     def _get_dir_owner(self, path: Path) -> str:
         """Get the owner of a directory"""
         try:
@@ -345,54 +635,181 @@ class UbuntuAdapter(PlatformAdapter):
         except:
             return "www-data"
     
-    def get_site_disk_usage(self, site: Dict) -> float:
-        """Get disk usage using du command"""
-        try:
-            path = site.get('path', '')
-            if not os.path.exists(path):
-                return 0.0
-            
-            result = subprocess.run(
-                ['du', '-sb', path],
-                stdout=PIPE,
-                stderr=PIPE,
-                text=True,
-                timeout=60
-            )
-            
-            if result.returncode == 0:
-                size_str = result.stdout.split()[0]
-                return float(size_str)
-        except Exception as e:
-            print(f"Error getting disk usage for {site.get('domain')}: {e}", file=sys.stderr)
-        
-        return 0.0
-    
-    def get_site_backup_status(self, site: Dict) -> Optional[int]:
+    def get_backup_locations(self, site: Dict) -> List[Tuple[str, str]]:
         """Check for backup files"""
+        return [(f"/var/backups/sites/{site['domain']}", '*')]
+
+
+class PhpFpmCollector:
+    """Attributes PHP-FPM worker CPU, memory and activity to sites
+
+    Workers are found by their process title ("php-fpm: pool NAME") and
+    matched to a site by, in order: pool name == domain, the pool's listen
+    socket path, the worker's cgroup path, and finally the pool name as the
+    owning user when that user has exactly one site.
+    """
+
+    def __init__(self, proc_path: str = '/proc'):
+        self.proc_path = proc_path
+        # (pid, starttime) -> (domain, pool, cpu seconds at last collection,
+        # cpu seconds already credited to an earlier domain of the worker)
+        self.workers: Dict[Tuple[int, int], Tuple[str, str, float, float]] = {}
+        # CPU seconds of workers that have since exited, so the counter stays monotonic
+        self.retired_cpu: Dict[Tuple[str, str], float] = defaultdict(float)
+        # (pool, socket path, cgroup) -> domain; pools rarely change between collections.
+        # Valid for the (domain, user) pairs it was built from
+        self.pool_sites: Dict[Tuple[str, str, str], str] = {}
+        self.pool_sites_key: frozenset = frozenset()
+
+    def collect(self, sites: List[Dict]) -> Dict[Tuple[str, str], Dict[str, float]]:
+        """Return usage keyed by (domain, pool)"""
+        domains = {site['domain']: site for site in sites}
+        sites_by_user = defaultdict(list)
+        for site in sites:
+            sites_by_user[site.get('user', '')].append(site['domain'])
+        # Sites added, removed or moved to another user can change any match
+        sites_key = frozenset((site['domain'], site.get('user', '')) for site in sites)
+        if sites_key != self.pool_sites_key:
+            self.pool_sites = {}
+            self.pool_sites_key = sites_key
+
+        usage = defaultdict(lambda: {'cpu_seconds': 0.0, 'rss_bytes': 0, 'workers': 0, 'active_workers': 0})
+        sockets = self._read_unix_sockets()
+        current = {}
+
         try:
-            backup_dir = Path('/var/backups/sites') / site['domain']
-            if backup_dir.exists():
-                backups = sorted(backup_dir.glob('*'), key=lambda p: p.stat().st_mtime, reverse=True)
-                if backups:
-                    return int(backups[0].stat().st_mtime)
-        except:
+            entries = os.scandir(self.proc_path)
+        except OSError:
+            return {}
+
+        with entries:
+            for entry in entries:
+                if not entry.name.isdigit():
+                    continue
+                worker = self._read_worker(entry.path)
+                if worker is None:
+                    continue
+                pool, starttime, state, cpu, rss, socket_inode, cgroup = worker
+
+                socket_path = sockets.get(socket_inode, '')
+                key = (pool, socket_path, cgroup)
+                if key not in self.pool_sites:
+                    self.pool_sites[key] = self._match_site(pool, socket_path, cgroup, domains, sites_by_user)
+                domain = self.pool_sites[key]
+
+                worker_key = (int(entry.name), starttime)
+                previous = self.workers.get(worker_key)
+                credited = 0.0
+                if previous is not None:
+                    credited = previous[3]
+                    if previous[0] != domain:
+                        # Matched to another site now: what the worker used so far
+                        # stays with the old series, so neither counter goes down
+                        self.retired_cpu[(previous[0], pool)] += previous[2] - credited
+                        credited = previous[2]
+                current[worker_key] = (domain, pool, cpu, credited)
+
+                stats = usage[(domain, pool)]
+                stats['cpu_seconds'] += cpu - credited
+                stats['rss_bytes'] += rss
+                stats['workers'] += 1
+                # Idle workers sleep in accept(); count a worker as active if it is
+                # running/in I/O now or has burned CPU since the last collection
+                if state in ('R', 'D') or (previous is not None and cpu > previous[2]):
+                    stats['active_workers'] += 1
+
+        for worker_key, (domain, pool, cpu, credited) in self.workers.items():
+            if worker_key not in current:
+                self.retired_cpu[(domain, pool)] += cpu - credited
+        self.workers = current
+
+        for key, retired in self.retired_cpu.items():
+            usage[key]['cpu_seconds'] += retired
+
+        return dict(usage)
+
+    def _read_worker(self, pid_path: str):
+        """Return (pool, starttime, state, cpu seconds, rss bytes, socket inode, cgroup) or None"""
+        try:
+            with open(f"{pid_path}/comm") as f:
+                if not f.read().startswith('php-fpm'):
+                    return None
+            with open(f"{pid_path}/cmdline", 'rb') as f:
+                title = f.read().replace(b'\0', b' ').decode('utf-8', 'replace').strip()
+            if not title.startswith('php-fpm: pool '):
+                return None  # master process
+            pool = title[len('php-fpm: pool '):].strip()
+
+            with open(f"{pid_path}/stat") as f:
+                # Fields after the parenthesised comm: state is index 0 (field 3)
+                fields = f.read().rsplit(')', 1)[1].split()
+            state = fields[0]
+            cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            starttime = int(fields[19])
+            rss = int(fields[21]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            return None  # process exited or is not readable
+
+        # FPM workers inherit the pool's listen socket as fd 0
+        socket_inode = ''
+        try:
+            target = os.readlink(f"{pid_path}/fd/0")
+            if target.startswith('socket:['):
+                socket_inode = target[8:-1]
+        except OSError:
             pass
-        return None
+
+        cgroup = ''
+        try:
+            with open(f"{pid_path}/cgroup") as f:
+                cgroup = f.read().strip()
+        except OSError:
+            pass
+
+        return pool, starttime, state, cpu, rss, socket_inode, cgroup
+
+    def _read_unix_sockets(self) -> Dict[str, str]:
+        """Map unix socket inode to its bound path from /proc/net/unix"""
+        sockets = {}
+        try:
+            with open(f"{self.proc_path}/net/unix") as f:
+                next(f, None)  # header
+                for line in f:
+                    parts = line.split()
+                    if len(parts) >= 8:
+                        sockets[parts[6]] = parts[7]
+        except OSError:
+            pass
+        return sockets
+
+    def _match_site(self, pool: str, socket_path: str, cgroup: str,
+                    domains: Dict[str, Dict], sites_by_user: Dict[str, List[str]]) -> str:
+        """Resolve a pool to a site domain"""
+        if pool in domains:
+            return pool
+
+        for source in (socket_path, cgroup):
+            if not source:
+                continue
+            # Longest match first so sub.example.com wins over example.com
+            for domain in sorted(domains, key=len, reverse=True):
+                if domain in source:
+                    return domain
+
+        owned = sites_by_user.get(pool, [])
+        if len(owned) == 1:
+            return owned[0]
+
+        return 'unknown'
+
+
+PHP_FPM_COLLECTOR = PhpFpmCollector()
 
 
 def get_platform_adapter() -> Optional[PlatformAdapter]:
     """Detect platform and return appropriate adapter"""
     try:
-        result = subprocess.run(
-            ['/bin/bash', os.path.join(os.path.dirname(__file__), 'platform-detect.sh'), '--json'],
-            stdout=PIPE,
-            stderr=PIPE,
-            text=True,
-            timeout=10
-        )
-        
-        platform_info = json.loads(result.stdout)
+        platform_info = get_platform_info()
         platform = platform_info.get('platform', 'unknown')
         
         if platform == 'plesk':
@@ -410,36 +827,74 @@ def get_platform_adapter() -> Optional[PlatformAdapter]:
         return None
 
 
-def collect_metrics(adapter: PlatformAdapter) -> PrometheusMetrics:
+def collect_metrics(adapter: PlatformAdapter, registry: MetricRegistry) -> MetricRegistry:
     """Collect all site metrics"""
-    metrics = PrometheusMetrics()
-    
     # Get list of sites
-    sites = adapter.get_sites()
+    with STATS.phase('discovery'):
+        sites = adapter.get_sites()
     
     print(f"Collecting metrics for {len(sites)} sites...", file=sys.stderr)
     
+    disk_bytes = registry.family('sqcdy_site_disk_bytes', 'Site disk usage in bytes', 'gauge', ('domain', 'user'))
+    with STATS.phase('disk'):
+        adapter.prepare_disk_usage(sites)
     for site in sites:
         domain = site.get('domain', 'unknown')
         user = site.get('user', 'unknown')
         
         # Disk usage
-        disk_usage = adapter.get_site_disk_usage(site)
-        metrics.add_metric(
-            'sqcdy_site_disk_bytes',
-            disk_usage,
-            labels={'domain': domain, 'user': user},
-            help_text='Site disk usage in bytes'
-        )
+        with STATS.phase('disk'):
+            scan_start = time.perf_counter()
+            disk_usage = adapter.get_site_disk_usage(site)
+            STATS.set('sqcdy_site_disk_scan_seconds', time.perf_counter() - scan_start, domain)
+        disk_bytes.add(disk_usage, domain, user)
+    
+    # Newest backup per site
+    backup_timestamp = registry.family('sqcdy_site_last_backup_timestamp',
+                                       'Unix time of the newest backup found for the site', 'gauge', ('domain', 'user'))
+    backup_size = registry.family('sqcdy_site_last_backup_size_bytes',
+                                  'Size of the newest backup found for the site in bytes', 'gauge', ('domain', 'user'))
+    with STATS.phase('backups'):
+        for site in sites:
+            backup = adapter.get_site_backup_status(site)
+            if backup:
+                domain, user = site.get('domain', 'unknown'), site.get('user', 'unknown')
+                backup_timestamp.add(backup[0], domain, user)
+                backup_size.add(backup[1], domain, user)
+    
+    # PHP-FPM pool usage attributed to sites
+    users = {site.get('domain'): site.get('user', 'unknown') for site in sites}
+    with STATS.phase('php_fpm'):
+        php_usage = sorted(PHP_FPM_COLLECTOR.collect(sites).items())
+    php_families = [
+        ('sqcdy_site_php_cpu_seconds_total', 'cpu_seconds', 'CPU seconds consumed by the site PHP-FPM pool workers', 'counter'),
+        ('sqcdy_site_php_memory_bytes', 'rss_bytes', 'Resident memory of the site PHP-FPM pool workers in bytes', 'gauge'),
+        ('sqcdy_site_php_workers', 'workers', 'Number of PHP-FPM workers in the site pool', 'gauge'),
+        ('sqcdy_site_php_active_workers', 'active_workers', 'PHP-FPM workers running or consuming CPU since the last collection', 'gauge'),
+    ]
+    for name, field, help_text, metric_type in php_families:
+        family = registry.family(name, help_text, metric_type, ('domain', 'user', 'pool'))
+        for (domain, pool), stats in php_usage:
+            family.add(round(stats[field], 2), domain, users.get(domain, 'unknown'), pool)
     
     # Add scrape metadata
-    metrics.add_metric(
-        'sqcdy_sites_total',
-        len(sites),
-        help_text='Total number of sites detected'
-    )
+    registry.family('sqcdy_sites_total', 'Total number of sites detected').add(len(sites))
     
-    return metrics
+    return registry
+
+
+def collect_scrape(adapter: PlatformAdapter) -> MetricRegistry:
+    """Collect site metrics followed by the exporter's own metrics"""
+    registry = MetricRegistry()
+    STATS.start_collection()
+    start_time = time.time()
+    try:
+        collect_metrics(adapter, registry)
+    except Exception:
+        STATS.finish_collection(time.time() - start_time, success=False)
+        raise
+    STATS.finish_collection(time.time() - start_time)
+    return STATS.add_to(registry)
 
 
 def background_collector(adapter: PlatformAdapter):
@@ -449,10 +904,10 @@ def background_collector(adapter: PlatformAdapter):
     while True:
         try:
             print("Background collection starting...", file=sys.stderr)
-            metrics = collect_metrics(adapter)
+            registry = collect_scrape(adapter)
             
             with METRICS_CACHE_LOCK:
-                METRICS_CACHE = metrics.render()
+                METRICS_CACHE = registry
             
             print("Background collection complete", file=sys.stderr)
         except Exception as e:
@@ -466,6 +921,7 @@ class MetricsHandler(BaseHTTPRequestHandler):
     """HTTP handler for Prometheus metrics endpoint"""
     
     adapter = None
+    profiler = None  # set when --enable-profiler is given
     
     def do_GET(self):
         if self.path == '/metrics':
@@ -474,21 +930,25 @@ class MetricsHandler(BaseHTTPRequestHandler):
                 
                 # Return cached metrics if available
                 with METRICS_CACHE_LOCK:
-                    response = METRICS_CACHE
+                    registry = METRICS_CACHE
 
-                if response is None:
+                if registry is None:
                     # First request before background thread has run - collect once
-                    metrics = collect_metrics(self.adapter)
-                    response = metrics.render()
+                    registry = collect_scrape(self.adapter)
                     with METRICS_CACHE_LOCK:
-                        METRICS_CACHE = response
+                        METRICS_CACHE = registry
                 
+                openmetrics = wants_openmetrics(self.headers.get('Accept'))
+                body = registry.render(openmetrics)
                 self.send_response(200)
-                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Type', CONTENT_TYPE_OPENMETRICS if openmetrics else CONTENT_TYPE_TEXT)
+                self.send_header('Content-Length', str(len(body)))
                 self.end_headers()
-                self.wfile.write(response.encode('utf-8'))
+                self.wfile.write(body)
             except Exception as e:
                 self.send_error(500, f"Error collecting metrics: {e}")
+        elif self.path.split('?')[0] == '/debug/profile' and self.profiler:
+            handle_profile_request(self, self.profiler)
         else:
             self.send_error(404)
     
@@ -501,8 +961,15 @@ def main():
     parser = argparse.ArgumentParser(description='Square Candy Site Metrics Exporter')
     parser.add_argument('--port', type=int, default=9101, help='Port to listen on (default: 9101)')
     parser.add_argument('--test', action='store_true', help='Run once and print metrics to stdout')
+    parser.add_argument('--enable-profiler', action='store_true',
+                        help='Serve a sampling profile of the collector at /debug/profile?seconds=N (localhost only)')
+    parser.add_argument('--disk-usage', choices=['auto', 'du'], default='auto',
+                        help='Disk usage source: auto uses user/project quotas where they cover a site and du elsewhere (default: auto)')
     args = parser.parse_args()
     
+    if args.disk_usage == 'du':
+        QUOTA_USAGE.enabled = False
+    
     # Get platform adapter
     adapter = get_platform_adapter()
     if not adapter:
@@ -513,8 +980,7 @@ def main():
     
     if args.test:
         # Test mode: collect and print metrics once
-        metrics = collect_metrics(adapter)
-        print(metrics.render())
+        sys.stdout.buffer.write(collect_scrape(adapter).render())
         sys.exit(0)
     
     # Start background collection thread
@@ -525,6 +991,11 @@ def main():
     )
     collector_thread.start()
     print("Started background metrics collector", file=sys.stderr)
+
+    if args.enable_profiler:
+        MetricsHandler.profiler = SamplingProfiler()
+        MetricsHandler.profiler.thread_ident = collector_thread.ident
+        print(f"Profiler available at http://localhost:{args.port}/debug/profile?seconds=10", file=sys.stderr)
     
     # Start HTTP server
     MetricsHandler.adapter = adapter
@@ -1,40 +1,90 @@
 #!/bin/bash
-# Square Candy Swap I/O Metrics Exporter
-# Reads pswpin/pswpout from /proc/vmstat as root, since grafana-agent
+# Square Candy Swap I/O & Memory Pressure Metrics Exporter
+# Reads /proc/vmstat and /proc/pressure/* as root, since grafana-agent
 # runs as a non-root user that is denied /proc/vmstat in Plesk VPS containers.
-# Exposes metrics using the same names node_exporter would use so the
+# vmstat fields are exposed using the same names node_exporter would use so the
 # existing dashboard queries work without modification.
 
 PORT="${SQCDY_SWAP_METRICS_PORT:-9104}"
+CACHE_TTL="${SQCDY_METRICS_CACHE_TTL:-10}"
+PYTHON_BIN="${SQCDY_PYTHON:-python3}"
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 
-get_swap_metrics() {
-    echo "# HELP node_vmstat_pswpin /proc/vmstat information field pswpin."
-    echo "# TYPE node_vmstat_pswpin untyped"
-    echo "# HELP node_vmstat_pswpout /proc/vmstat information field pswpout."
-    echo "# TYPE node_vmstat_pswpout untyped"
+# /proc/vmstat fields to export. A trailing * matches by prefix, e.g. allocstall*
+# covers allocstall_normal, allocstall_movable, ... on newer kernels.
+VMSTAT_FIELDS="${SQCDY_VMSTAT_FIELDS:-pswpin pswpout pgfault pgmajfault allocstall* oom_kill pgscan_kswapd pgscan_direct pgsteal_kswapd pgsteal_direct}"
+# PSI resources to export from /proc/pressure (kernel 4.20+)
+PRESSURE_RESOURCES="${SQCDY_PRESSURE_RESOURCES:-cpu memory io}"
+
+get_vmstat_metrics() {
+    # Single pass over /proc/vmstat, keeping only allowlisted fields
+    [ -r /proc/vmstat ] || return 0
+    awk -v fields="$VMSTAT_FIELDS" '
+    BEGIN {
+        n = split(fields, list, " ")
+        for (i = 1; i <= n; i++) {
+            if (list[i] ~ /\*$/) prefix[substr(list[i], 1, length(list[i]) - 1)] = 1
+            else exact[list[i]] = 1
+        }
+    }
+    {
+        keep = ($1 in exact)
+        if (!keep) for (p in prefix) if (index($1, p) == 1) { keep = 1; break }
+        if (!keep) next
+        printf "# HELP node_vmstat_%s /proc/vmstat information field %s.\n", $1, $1
+        printf "# TYPE node_vmstat_%s untyped\n", $1
+        printf "node_vmstat_%s %s\n", $1, $2
+    }' /proc/vmstat
+}
 
-    local pswpin pswpout
-    pswpin=$(awk '/^pswpin/ {print $2}' /proc/vmstat)
-    pswpout=$(awk '/^pswpout/ {print $2}' /proc/vmstat)
+get_pressure_metrics() {
+    local files=() resource
+    for resource in $PRESSURE_RESOURCES; do
+        [ -r "/proc/pressure/$resource" ] && files+=("/proc/pressure/$resource")
+    done
+    [ ${#files[@]} -eq 0 ] && return 0
 
-    echo "node_vmstat_pswpin ${pswpin:-0}"
-    echo "node_vmstat_pswpout ${pswpout:-0}"
+    # Lines look like: some avg10=0.12 avg60=0.05 avg300=0.01 total=123456
+    # Samples are buffered so each metric family is printed as one group
+    awk '
+    {
+        n = split(FILENAME, path, "/")
+        resource = path[n]
+        for (i = 2; i <= NF; i++) {
+            split($i, kv, "=")
+            if (kv[1] == "total") {
+                family = ($1 == "some") ? "waiting" : "stalled"
+                totals[family] = totals[family] sprintf("sqcdy_pressure_%s_seconds_total{resource=\"%s\"} %.6f\n", family, resource, kv[2] / 1000000)
+            } else {
+                avgs = avgs sprintf("sqcdy_pressure_stall_percent{resource=\"%s\",kind=\"%s\",window=\"%ss\"} %s\n", resource, $1, substr(kv[1], 4), kv[2])
+            }
+        }
+    }
+    END {
+        print "# HELP sqcdy_pressure_stall_percent Share of time tasks were stalled on the resource (PSI avg10/avg60/avg300)"
+        print "# TYPE sqcdy_pressure_stall_percent gauge"
+        printf "%s", avgs
+        print "# HELP sqcdy_pressure_waiting_seconds_total Total time some tasks were stalled on the resource"
+        print "# TYPE sqcdy_pressure_waiting_seconds_total counter"
+        printf "%s", totals["waiting"]
+        print "# HELP sqcdy_pressure_stalled_seconds_total Total time all non-idle tasks were stalled on the resource"
+        print "# TYPE sqcdy_pressure_stalled_seconds_total counter"
+        printf "%s", totals["stalled"]
+    }' "${files[@]}"
+}
+
+get_swap_metrics() {
+    get_vmstat_metrics
+    get_pressure_metrics
 }
 
 serve_metrics() {
     echo "Starting swap metrics exporter on port $PORT" >&2
 
-    while true; do
-        {
-            echo -e "HTTP/1.1 200 OK\r"
-            echo -e "Content-Type: text/plain; version=0.0.4\r"
-            echo -e "Connection: close\r"
-            echo -e "\r"
-            get_swap_metrics
-        } | nc -l -p "$PORT" -q 1 2>/dev/null || {
-            echo -e "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nConnection: close\r\n\r\n$(get_swap_metrics)" | nc -l "$PORT" 2>/dev/null
-        }
-    done
+    # metrics-server.py runs "--test" on demand for each scrape (cached for
+    # CACHE_TTL seconds) and serves concurrent keep-alive clients
+    exec "$PYTHON_BIN" "$SCRIPT_DIR/metrics-server.py" --port "$PORT" --ttl "$CACHE_TTL" --name swap-metrics \
+        -- /bin/bash "$SCRIPT_DIR/$(basename "${BASH_SOURCE[0]}")" --test
 }
 
 case "${1:-}" in
@@ -44,7 +94,11 @@ case "${1:-}" in
         ;;
     --help)
         echo "Usage: $0 [--test|--help]"
-        echo "Serves swap I/O metrics from /proc/vmstat on port $PORT"
+        echo "Serves /proc/vmstat and /proc/pressure metrics on port $PORT"
+        echo ""
+        echo "Environment:"
+        echo "  SQCDY_VMSTAT_FIELDS       vmstat fields to export (trailing * matches a prefix)"
+        echo "  SQCDY_PRESSURE_RESOURCES  PSI resources to export (default: cpu memory io)"
         exit 0
         ;;
     *)
@@ -7,10 +7,14 @@ set -e
 
 PORT="${SQCDY_USER_METRICS_PORT:-9102}"
 INTERVAL="${SQCDY_SCRAPE_INTERVAL:-60}"
+CACHE_TTL="${SQCDY_METRICS_CACHE_TTL:-10}"
+PYTHON_BIN="${SQCDY_PYTHON:-python3}"
 
-# Get platform info
+# Get platform info (skipped when already exported, e.g. by the metrics server's parent)
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
-eval "$("$SCRIPT_DIR/platform-detect.sh" --env)"
+if [ -z "${SQCDY_PLATFORM:-}" ]; then
+    eval "$("$SCRIPT_DIR/platform-detect.sh" --env)"
+fi
 
 get_user_metrics() {
     # Header
@@ -53,19 +57,10 @@ get_user_metrics() {
 serve_metrics() {
     echo "Starting user metrics exporter on port $PORT" >&2
     
-    while true; do
-        # Listen for HTTP requests using netcat
-        {
-            echo -e "HTTP/1.1 200 OK\r"
-            echo -e "Content-Type: text/plain; version=0.0.4\r"
-            echo -e "Connection: close\r"
-            echo -e "\r"
-            get_user_metrics
-        } | nc -l -p "$PORT" -q 1 2>/dev/null || {
-            # Fallback for systems without nc -q
-            echo -e "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nConnection: close\r\n\r\n$(get_user_metrics)" | nc -l "$PORT" 2>/dev/null
-        }
-    done
+    # metrics-server.py runs "--test" on demand for each scrape (cached for
+    # CACHE_TTL seconds) and serves concurrent keep-alive clients
+    exec "$PYTHON_BIN" "$SCRIPT_DIR/metrics-server.py" --port "$PORT" --ttl "$CACHE_TTL" --name user-metrics \
+        -- /bin/bash "$SCRIPT_DIR/$(basename "${BASH_SOURCE[0]}")" --test
 }
 
 # Handle arguments
@@ -0,0 +1,323 @@
+"""
+Square Candy Vhost Config Parser
+Reads nginx server blocks and Apache <VirtualHost> sections, following
+include globs, and returns one entry per block with its server names, root
+and log paths. Each file is parsed once and reused until its mtime or size
+changes, so repeated discovery only costs a stat per file.
+"""
+
+import os
+import sys
+import glob
+from typing import Dict, List, Optional, Tuple
+
+NGINX_MAIN_CONFIGS = ('/etc/nginx/nginx.conf',)
+NGINX_CONFIG_DIRS = ('/etc/nginx/sites-enabled', '/etc/nginx/conf.d')
+APACHE_MAIN_CONFIGS = ('/etc/apache2/apache2.conf', '/etc/httpd/conf/httpd.conf')
+APACHE_CONFIG_DIRS = ('/etc/apache2/sites-enabled', '/etc/httpd/conf.d')
+
+# Guards against include cycles
+MAX_INCLUDE_DEPTH = 16
+
+
+def tokenize_nginx(text: str) -> List[str]:
+    """Split nginx config text into words, quoted strings, '{', '}' and ';'"""
+    tokens = []
+    i, length = 0, len(text)
+    while i < length:
+        c = text[i]
+        if c.isspace():
+            i += 1
+        elif c == '#':
+            end = text.find('\n', i)
+            i = length if end < 0 else end + 1
+        elif c in '{};':
+            tokens.append(c)
+            i += 1
+        elif c in '"\'':
+            j = i + 1
+            chars = []
+            while j < length and text[j] != c:
+                if text[j] == '\\' and j + 1 < length:
+                    j += 1
+                chars.append(text[j])
+                j += 1
+            tokens.append(''.join(chars))
+            i = j + 1
+        else:
+            j = i
+            while j < length and not text[j].isspace() and text[j] not in '{};':
+                j += 1
+            tokens.append(text[i:j])
+            i = j
+    return tokens
+
+
+def parse_nginx(tokens: List[str]) -> List:
+    """Turn tokens into nested directives: [name, [args], children or None]"""
+    root: List = []
+    stack = [root]
+    words: List[str] = []
+    for token in tokens:
+        if token == ';':
+            if words:
+                stack[-1].append([words[0], words[1:], None])
+            words = []
+        elif token == '{':
+            block: List = []
+            stack[-1].append([words[0] if words else '', words[1:], block])
+            stack.append(block)
+            words = []
+        elif token == '}':
+            if len(stack) > 1:
+                stack.pop()
+            words = []
+        else:
+            words.append(token)
+    return root
+
+
+def split_apache_args(line: str) -> List[str]:
+    """Split an Apache directive line, honouring double quotes"""
+    args = []
+    current: List[str] = []
+    quoted = False
+    has_token = False
+    for c in line:
+        if c == '"':
+            quoted = not quoted
+            has_token = True
+        elif c.isspace() and not quoted:
+            if has_token:
+                args.append(''.join(current))
+                current, has_token = [], False
+        else:
+            current.append(c)
+            has_token = True
+    if has_token:
+        args.append(''.join(current))
+    return args
+
+
+def parse_apache(text: str) -> List:
+    """Apache config as nested directives: [name, [args], children or None]"""
+    root: List = []
+    stack = [root]
+    pending = ''
+    for raw in text.splitlines():
+        line = raw.strip()
+        if line.endswith('\\'):
+            pending += line[:-1] + ' '
+            continue
+        line = (pending + line).strip()
+        pending = ''
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('</'):
+            if len(stack) > 1:
+                stack.pop()
+        elif line.startswith('<') and line.endswith('>'):
+            words = split_apache_args(line[1:-1])
+            block: List = []
+            stack[-1].append([words[0] if words else '', words[1:], block])
+            stack.append(block)
+        else:
+            words = split_apache_args(line)
+            stack[-1].append([words[0], words[1:], None])
+    return root
+
+
+def _log_path(args: List[str]) -> Optional[str]:
+    """File path of an access_log/CustomLog directive, if it writes to a plain file"""
+    if not args:
+        return None
+    # Debian's apache2.conf logs to ${APACHE_LOG_DIR}, set in /etc/apache2/envvars
+    path = args[0].replace('${APACHE_LOG_DIR}', os.environ.get('APACHE_LOG_DIR', '/var/log/apache2'))
+    if path in ('off', 'stderr') or path.startswith(('syslog:', '|', 'memory:')) or '$' in path:
+        return None
+    return path
+
+
+class VhostConfig:
+    """Parsed vhosts of the local nginx and Apache configs"""
+
+    def __init__(self):
+        # path -> (mtime_ns, size, directives)
+        self.files: Dict[str, Tuple[int, int, List]] = {}
+
+    def get_vhosts(self) -> List[Dict]:
+        """One dict per server block / VirtualHost, nginx first"""
+        seen: Dict[str, int] = {}
+        vhosts = self._load('nginx', NGINX_MAIN_CONFIGS, NGINX_CONFIG_DIRS, seen)
+        vhosts.extend(self._load('apache', APACHE_MAIN_CONFIGS, APACHE_CONFIG_DIRS, seen))
+        # Forget files that are no longer included anywhere
+        self.files = {path: entry for path, entry in self.files.items() if path in seen}
+        return vhosts
+
+    def get_sites(self) -> Dict[str, Dict]:
+        """Vhosts merged by primary server name (e.g. the :80 and :443 blocks of one site)"""
+        sites: Dict[str, Dict] = {}
+        for vhost in self.get_vhosts():
+            site = sites.get(vhost['domain'])
+            if site is None:
+                sites[vhost['domain']] = {
+                    'domain': vhost['domain'],
+                    'aliases': list(vhost['aliases']),
+                    'root': vhost['root'],
+                    'access_logs': list(vhost['access_logs']),
+                    'error_logs': list(vhost['error_logs']),
+                }
+                continue
+            site['root'] = site['root'] or vhost['root']
+            for key in ('aliases', 'access_logs', 'error_logs'):
+                site[key].extend(value for value in vhost[key] if value not in site[key])
+        return sites
+
+    def _load(self, server: str, main_configs: Tuple[str, ...], config_dirs: Tuple[str, ...],
+              seen: Dict[str, int]) -> List[Dict]:
+        main = next((path for path in main_configs if os.path.isfile(path)), None)
+        if main:
+            # Relative includes resolve against the nginx prefix / Apache ServerRoot
+            prefix = os.path.dirname(main)
+            if server == 'apache' and prefix.endswith('/conf'):
+                # Red Hat layout: ServerRoot is /etc/httpd
+                prefix = os.path.dirname(prefix)
+            directives = self._expand(server, main, prefix, seen, 0)
+        else:
+            # No main config: read the site directories directly
+            directives = []
+            for config_dir in config_dirs:
+                for path in sorted(glob.glob(os.path.join(config_dir, '*'))):
+                    if os.path.isfile(path):
+                        directives.extend(self._expand(server, path, os.path.dirname(config_dir), seen, 0))
+
+        vhosts: List[Dict] = []
+        self._collect(server, directives, vhosts)
+        return vhosts
+
+    def _expand(self, server: str, path: str, prefix: str, seen: Dict[str, int], depth: int) -> List:
+        """Directives of a file with its include directives replaced by the included files"""
+        if depth > MAX_INCLUDE_DEPTH:
+            print(f"Include depth exceeded at {path}", file=sys.stderr)
+            return []
+        seen[path] = depth
+        directives = self._parse_file(server, path)
+        return self._resolve_includes(server, directives, prefix, seen, depth)
+
+    def _resolve_includes(self, server: str, directives: List, prefix: str, seen: Dict[str, int], depth: int) -> List:
+        result = []
+        for name, args, children in directives:
+            lowered = name.lower()
+            if children is None and args and lowered in ('include', 'includeoptional'):
+                pattern = args[0] if os.path.isabs(args[0]) else os.path.join(prefix, args[0])
+                for included in sorted(glob.glob(pattern)):
+                    if os.path.isdir(included):
+                        # Apache accepts a directory and reads every file in it
+                        included = os.path.join(included, '*')
+                        files = sorted(p for p in glob.glob(included) if os.path.isfile(p))
+                    else:
+                        files = [included]
+                    for file_path in files:
+                        result.extend(self._expand(server, file_path, prefix, seen, depth + 1))
+            elif children is not None:
+                result.append([name, args, self._resolve_includes(server, children, prefix, seen, depth)])
+            else:
+                result.append([name, args, children])
+        return result
+
+    def _parse_file(self, server: str, path: str) -> List:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return []
+        cached = self.files.get(path)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            return cached[2]
+        try:
+            with open(path, errors='replace') as f:
+                text = f.read()
+        except OSError as e:
+            print(f"Error reading {path}: {e}", file=sys.stderr)
+            return []
+        directives = parse_nginx(tokenize_nginx(text)) if server == 'nginx' else parse_apache(text)
+        self.files[path] = (st.st_mtime_ns, st.st_size, directives)
+        return directives
+
+    def _collect(self, server: str, directives: List, vhosts: List[Dict]):
+        block_name = 'server' if server == 'nginx' else 'virtualhost'
+        for name, args, children in directives:
+            if children is None:
+                continue
+            if name.lower() == block_name:
+                vhost = self._nginx_vhost(children) if server == 'nginx' else self._apache_vhost(children)
+                if vhost:
+                    vhost['server'] = server
+                    vhosts.append(vhost)
+            else:
+                # http { }, <IfModule>, ... may wrap the vhost blocks
+                self._collect(server, children, vhosts)
+
+    @staticmethod
+    def _nginx_vhost(directives: List) -> Optional[Dict]:
+        names: List[str] = []
+        root = None
+        access_logs: List[str] = []
+        error_logs: List[str] = []
+        for name, args, children in directives:
+            if children is not None:
+                continue
+            if name == 'server_name':
+                names.extend(arg for arg in args if arg not in ('_', '""', '') and not arg.startswith('~'))
+            elif name == 'root' and args and root is None:
+                root = args[0]
+            elif name == 'access_log':
+                path = _log_path(args)
+                if path:
+                    access_logs.append(path)
+            elif name == 'error_log':
+                path = _log_path(args)
+                if path:
+                    error_logs.append(path)
+        return VhostConfig._vhost(names, root, access_logs, error_logs)
+
+    @staticmethod
+    def _apache_vhost(directives: List) -> Optional[Dict]:
+        names: List[str] = []
+        aliases: List[str] = []
+        root = None
+        access_logs: List[str] = []
+        error_logs: List[str] = []
+        for name, args, children in directives:
+            if children is not None:
+                continue
+            lowered = name.lower()
+            if lowered == 'servername' and args:
+                # ServerName may carry a scheme and port
+                names.append(args[0].split('://')[-1].split(':')[0])
+            elif lowered == 'serveralias':
+                aliases.extend(args)
+            elif lowered == 'documentroot' and args:
+                root = args[0]
+            elif lowered in ('customlog', 'transferlog'):
+                path = _log_path(args)
+                if path:
+                    access_logs.append(path)
+            elif lowered == 'errorlog':
+                path = _log_path(args)
+                if path:
+                    error_logs.append(path)
+        return VhostConfig._vhost(names + aliases, root, access_logs, error_logs)
+
+    @staticmethod
+    def _vhost(names: List[str], root: Optional[str], access_logs: List[str], error_logs: List[str]) -> Optional[Dict]:
+        # The first non-wildcard name identifies the site
+        primary = next((name for name in names if '*' not in name), None)
+        if primary is None:
+            return None
+        return {
+            'domain': primary.lower(),
+            'aliases': [name.lower() for name in names if name != primary],
+            'root': root,
+            'access_logs': access_logs,
+            'error_logs': error_logs,
+        }
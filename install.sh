@@ -205,10 +205,10 @@ if [ "$SQCDY_PLATFORM" = "gridpane" ]; then
     echo -e "${GREEN}✓ Assuming dependencies (python3, curl) already installed${NC}"
 elif command -v apt-get &> /dev/null; then
     apt-get update -qq --allow-releaseinfo-change
-    apt-get install -y -qq curl python3 python3-pip netcat > /dev/null 2>&1
+    apt-get install -y -qq curl python3 python3-pip > /dev/null 2>&1
     echo -e "${GREEN}✓ Dependencies installed (Debian/Ubuntu)${NC}"
 elif command -v yum &> /dev/null; then
-    yum install -y -q curl python3 python3-pip nc > /dev/null 2>&1
+    yum install -y -q curl python3 python3-pip > /dev/null 2>&1
     echo -e "${GREEN}✓ Dependencies installed (RHEL/CentOS)${NC}"
 else
     echo -e "${YELLOW}⚠ Unknown package manager, skipping dependency installation${NC}"
@@ -503,6 +503,7 @@ After=network.target
 [Service]
 Type=simple
 User=root
+Environment="SQCDY_PYTHON=$PYTHON_BIN"
 ExecStart=$INSTALL_DIR/exporters/user-metrics.sh
 Restart=always
 RestartSec=10
@@ -520,6 +521,7 @@ After=network.target
 [Service]
 Type=simple
 User=root
+Environment="SQCDY_PYTHON=$PYTHON_BIN"
 ExecStart=$INSTALL_DIR/exporters/swap-metrics.sh
 Restart=always
 RestartSec=10
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""Memory benchmark for log-analyzer.py
+
+Writes a synthetic GridPane access log per domain (500 domains by default,
+sharing IP, URL and user agent pools the way sites on one server do) and
+runs each variant in its own process:
+
+- collect: one real collect_metrics() run, which analyzes and exports one
+  domain at a time. Its peak RSS is what a server sees.
+- dict / compact: every domain's aggregate kept alive at once, with the old
+  layout (a dict of str-keyed Counters per domain) or with SiteAggregate.
+  This compares the size of the aggregates, not the exporter's footprint.
+
+The JSON output has the RSS before and after, the peak RSS and the time taken.
+
+    python3 tests/bench-log-memory.py --domains 500 --requests 5000
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import importlib.util
+from collections import Counter
+from datetime import datetime, timedelta
+
+EXPORTERS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'exporters')
+VARIANTS = ('collect', 'dict', 'compact')
+
+COMMON_URLS = ['/', '/wp-login.php', '/xmlrpc.php', '/wp-admin/admin-ajax.php', '/feed/', '/robots.txt',
+               '/wp-json/wp/v2/posts', '/favicon.ico', '/sitemap.xml', '/wp-cron.php']
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{v}.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_{v} like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html) v{v}',
+    'Mozilla/5.0 (compatible; AhrefsBot/7.0; +http://ahrefs.com/robot/) v{v}',
+    'curl/8.{v}.0',
+]
+
+
+def rss_bytes() -> int:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def generate(log_dir: str, args):
+    """One DOMAIN.access.log per domain, all within the analysis window"""
+    rng = random.Random(args.seed)
+    ips = [f'{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}'
+           for _ in range(args.ip_pool)]
+    ips += [f'2001:db8:{rng.randint(0, 65535):x}::{rng.randint(1, 65535):x}' for _ in range(args.ip_pool // 5)]
+    user_agents = [ua.format(v=v) for ua in USER_AGENTS for v in range(40)]
+    now = datetime.now()
+
+    for n in range(args.domains):
+        domain = f'site{n}.example.com'
+        # Mostly shared paths plus the site's own pages
+        urls = COMMON_URLS + [f'/{domain.split(".")[0]}/page-{i}/' for i in range(args.urls)]
+        with open(os.path.join(log_dir, f'{domain}.access.log'), 'w') as f:
+            for _ in range(args.requests):
+                t = (now - timedelta(seconds=rng.randint(0, 600))).strftime('%d/%b/%Y:%H:%M:%S')
+                status = rng.choice((200, 200, 200, 200, 301, 304, 404, 500))
+                f.write(f'[{t} +0000] {rng.choice(ips)} 0.052 - {domain} "GET {rng.choice(urls)}?v={rng.randint(0, 9)} HTTP/1.1" '
+                        f'{status} {rng.randint(200, 90000)} 0.052 "-" "{rng.choice(user_agents)}"\n')
+
+
+def load_log_analyzer(exporters_dir: str):
+    sys.path.insert(0, exporters_dir)
+    spec = importlib.util.spec_from_file_location('log_analyzer', os.path.join(exporters_dir, 'log-analyzer.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def dict_aggregate(analyzer, log_files):
+    """The per-domain layout used before SiteAggregate: str keys, one Counter per table"""
+    metrics = {'requests_total': 0, 'bytes_total': 0, 'top_ips': Counter(), 'top_user_agents': Counter(),
+               'top_urls': Counter(), 'status_codes': Counter(), 'agent_classes': Counter()}
+    for log_file in log_files:
+        with open(log_file, errors='ignore') as f:
+            for line in f:
+                entry = analyzer.parse_log_line(line)
+                if not entry or analyzer.parse_time(entry['time']) < analyzer.cutoff_time:
+                    continue
+                metrics['requests_total'] += 1
+                metrics['bytes_total'] += int(entry['size'])
+                metrics['top_ips'][entry['ip']] += 1
+                ua = entry['user_agent']
+                family, category = analyzer.ua_classifier.classify(ua)
+                metrics['agent_classes'][(category, family)] += 1
+                if ua and ua != '-':
+                    metrics['top_user_agents'][family if analyzer.ua_families else ua[:100]] += 1
+                metrics['top_urls'][analyzer.url_normalizer.normalize(entry['url'])] += 1
+                metrics['status_codes'][entry['status']] += 1
+    return metrics
+
+
+def worker(args):
+    """Run in a child process: one collection, or every domain's aggregate kept"""
+    log_analyzer = load_log_analyzer(args.exporters)
+    url_normalizer = log_analyzer.UrlNormalizer(collapse_segments=not args.raw_urls)
+    analyzer = log_analyzer.LogAnalyzer({'platform': 'gridpane', 'log_path': args.worker},
+                                        url_normalizer=url_normalizer, ua_families=not args.raw_user_agents)
+    log_files = analyzer.get_log_files()
+
+    before = rss_bytes()
+    start = time.perf_counter()
+    aggregates = {}
+    output = b''
+    if args.variant == 'collect':
+        # Rendered too, as the HTTP handler does
+        output = analyzer.collect_metrics().render()
+    for domain, files in log_files.items():
+        if args.variant == 'dict':
+            aggregates[domain] = dict_aggregate(analyzer, files)
+        elif args.variant == 'compact':
+            aggregates[domain] = analyzer.analyze_site_logs(domain, files)
+    elapsed = time.perf_counter() - start
+    after = rss_bytes()
+
+    json.dump({
+        'variant': args.variant,
+        'domains': len(log_files),
+        'seconds': round(elapsed, 3),
+        'rss_before_bytes': before,
+        'rss_after_bytes': after,
+        'retained_bytes': after - before,
+        'output_bytes': len(output),
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }, sys.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory benchmark for log-analyzer.py per-domain aggregates')
+    parser.add_argument('--domains', type=int, default=500, help='Domains (default: 500)')
+    parser.add_argument('--requests', type=int, default=2000, help='Log lines per domain (default: 2000)')
+    parser.add_argument('--urls', type=int, default=300, help='Site-specific URLs per domain (default: 300)')
+    parser.add_argument('--ip-pool', type=int, default=50000, help='IPv4 addresses shared by all domains, plus 20%% IPv6 (default: 50000)')
+    parser.add_argument('--raw-urls', action='store_true', help='Do not collapse URL segments (more distinct URLs)')
+    parser.add_argument('--raw-user-agents', action='store_true', help='Keep raw user agents instead of families')
+    parser.add_argument('--variants', default=','.join(VARIANTS), help=f'Variants to run (default: {",".join(VARIANTS)})')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the workload (default: 1)')
+    parser.add_argument('--workdir', default=None, help='Where to write the logs (default: system temp dir)')
+    parser.add_argument('--exporters', default=EXPORTERS_DIR, help='Directory holding log-analyzer.py')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--variant', default='compact', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    log_dir = tempfile.mkdtemp(prefix='sqcdy-bench-logs-', dir=args.workdir)
+    report = {
+        'benchmark': 'log-memory',
+        'parameters': {key: getattr(args, key) for key in ('domains', 'requests', 'urls', 'ip_pool', 'raw_urls', 'raw_user_agents')},
+        'results': [],
+    }
+    try:
+        generate(log_dir, args)
+        for variant in args.variants.split(','):
+            command = [sys.executable, os.path.abspath(__file__), '--exporters', args.exporters,
+                       '--variant', variant, '--worker', log_dir]
+            if args.raw_urls:
+                command.append('--raw-urls')
+            if args.raw_user_agents:
+                command.append('--raw-user-agents')
+            env = dict(os.environ, SQCDY_PLATFORM_CACHE=os.path.join(log_dir, 'platform.json'))
+            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, env=env, check=True)
+            run = json.loads(result.stdout)
+            report['results'].append(run)
+            print(f"{variant}: {run['retained_bytes'] / 1048576:.1f} MiB retained, "
+                  f"{run['peak_rss_bytes'] / 1048576:.1f} MiB peak, {run['seconds']}s", file=sys.stderr)
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""Benchmark site-metrics.py disk collection against synthetic site trees
+
+Builds throwaway Plesk, GridPane and /var/www/sites/USER/DOMAIN layouts,
+runs the matching platform adapter against each (the tree root is injected
+through platform_info['site_path']) and prints JSON with wall time, peak RSS
+and, with --strace, syscalls and files visited per platform and disk-usage
+strategy.
+
+Each run happens in a fresh child process so peak RSS and caches are not
+shared between runs. Syscalls are only counted when strace is installed
+and --strace is given. The page cache is warm after generation, so the
+numbers compare code paths rather than disk speed.
+
+    python3 tests/bench-site-metrics.py --sites 50 --files 2000 --depth 3 --hardlinks 100 > before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import importlib.util
+
+EXPORTERS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'exporters')
+PLATFORMS = ('plesk', 'gridpane', 'ubuntu')
+# --disk-usage choices of site-metrics.py
+STRATEGIES = ('auto', 'du')
+# Subdirectories per directory level
+FANOUT = 8
+# Syscalls that look at one file or directory entry (du and os.walk/os.stat alike)
+STAT_CALLS = ('newfstatat', 'fstatat64', 'statx', 'lstat', 'stat', 'lstat64', 'stat64')
+
+
+def site_files(root: str, files: int, depth: int):
+    """Paths of `files` files spread over `depth` directory levels below root"""
+    for i in range(files):
+        parts = [f'd{(i // FANOUT ** level) % FANOUT}' for level in range(depth)]
+        yield os.path.join(root, *parts, f'f{i}.php')
+
+
+def populate(root: str, args) -> dict:
+    """Fill one site directory; returns counts of what was created"""
+    counts = {'files': 0, 'dirs': 0, 'hardlinks': 0, 'bytes': 0}
+    data = b'x' * args.file_size
+    paths = []
+    directories = set()
+    for path in site_files(root, args.files, args.depth):
+        directory = os.path.dirname(path)
+        if directory not in directories:
+            os.makedirs(directory, exist_ok=True)
+            # Count the intermediate levels created along the way too
+            while directory != root and directory not in directories:
+                directories.add(directory)
+                counts['dirs'] += 1
+                directory = os.path.dirname(directory)
+        with open(path, 'wb') as f:
+            f.write(data)
+        paths.append(path)
+        counts['files'] += 1
+        counts['bytes'] += args.file_size
+    # Hard links back into the tree, as left by some backup and deploy tools
+    for i in range(min(args.hardlinks, len(paths))):
+        os.link(paths[i], f'{paths[i]}.link')
+        counts['hardlinks'] += 1
+    return counts
+
+
+def generate(base: str, layout: str, args) -> dict:
+    """Create one platform layout under base; returns its platform_info and counts"""
+    user = os.environ.get('USER') or str(os.getuid())
+    totals = {'files': 0, 'dirs': 0, 'hardlinks': 0, 'bytes': 0}
+
+    for n in range(args.sites):
+        domain = f'site{n}.example.com'
+        if layout == 'plesk':
+            site_root = os.path.join(base, 'vhosts', domain)
+            docroot = os.path.join(site_root, 'httpdocs')
+            conf_dir = os.path.join(base, 'vhosts', 'system', domain, 'conf')
+            os.makedirs(conf_dir)
+            with open(os.path.join(conf_dir, 'httpd.conf'), 'w') as f:
+                f.write(f'<VirtualHost *:443>\n    ServerName "{domain}"\n    DocumentRoot "{docroot}"\n'
+                        f'    SuexecUserGroup "{user}" "psacln"\n</VirtualHost>\n')
+        elif layout == 'gridpane':
+            site_root = os.path.join(base, 'www', domain)
+            docroot = os.path.join(site_root, 'htdocs')
+        else:
+            site_root = os.path.join(base, 'www', 'sites', f'user{n % 10}', domain)
+            docroot = os.path.join(site_root, 'public_html')
+        os.makedirs(docroot)
+        for key, value in populate(docroot, args).items():
+            totals[key] += value
+
+    site_path = os.path.join(base, 'vhosts' if layout == 'plesk' else 'www')
+    platform_name = 'ubuntu-nginx' if layout == 'ubuntu' else layout
+    return {'platform_info': {'platform': platform_name, 'site_path': site_path}, 'tree': totals}
+
+
+def load_site_metrics(exporters_dir: str):
+    sys.path.insert(0, exporters_dir)
+    spec = importlib.util.spec_from_file_location('site_metrics', os.path.join(exporters_dir, 'site-metrics.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def worker(args):
+    """Run in a child process: one collection, result as JSON on stdout"""
+    site_metrics = load_site_metrics(args.exporters)
+    platform_info = json.loads(args.worker)
+    adapters = {
+        'plesk': site_metrics.PleskAdapter,
+        'gridpane': site_metrics.GridPaneAdapter,
+        'ubuntu-nginx': site_metrics.UbuntuAdapter,
+    }
+    adapter = adapters[platform_info['platform']](platform_info)
+    if args.strategy == 'du':
+        site_metrics.QUOTA_USAGE.enabled = False
+
+    start = time.perf_counter()
+    registry = site_metrics.collect_scrape(adapter)
+    wall = time.perf_counter() - start
+
+    disk = registry.families['sqcdy_site_disk_bytes'].samples
+    json.dump({
+        'wall_seconds': round(wall, 4),
+        'phases': {name: round(seconds, 4) for name, seconds in sorted(site_metrics.STATS.phases.items())},
+        'sites': len(disk),
+        'disk_bytes': int(sum(sample[3] for sample in disk)),
+        # ru_maxrss is in KiB on Linux. Not reported for du children: a forked
+        # child's peak includes the Python image it was forked from
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }, sys.stdout)
+
+
+def count_syscalls(summary_path: str) -> dict:
+    """Totals from an `strace -c` summary, plus the stat calls as files visited"""
+    result = {'total': None, 'files_visited': None, 'by_call': {}}
+    try:
+        with open(summary_path) as f:
+            for line in f:
+                fields = line.split()
+                # The total line has no usecs/call column, so it is summed instead
+                if len(fields) >= 5 and fields[0][0].isdigit() and fields[-1] != 'total':
+                    result['by_call'][fields[-1]] = int(fields[3])
+    except (OSError, ValueError):
+        pass
+    if result['by_call']:
+        result['total'] = sum(result['by_call'].values())
+        result['files_visited'] = sum(result['by_call'].get(name, 0) for name in STAT_CALLS)
+    result['by_call'] = dict(sorted(result['by_call'].items(), key=lambda item: -item[1])[:10])
+    return result
+
+
+def run_one(info: dict, strategy: str, args) -> dict:
+    command = [sys.executable, os.path.abspath(__file__), '--exporters', args.exporters,
+               '--strategy', strategy, '--worker', json.dumps(info['platform_info'])]
+    summary_path = None
+    if args.strace:
+        with tempfile.NamedTemporaryFile(prefix='strace-', suffix='.txt', delete=False) as f:
+            summary_path = f.name
+        command = ['strace', '-f', '-c', '-o', summary_path] + command
+    env = dict(os.environ, SQCDY_PLATFORM_CACHE=os.path.join(args.base, 'platform.json'))
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, env=env, check=True)
+    run = json.loads(result.stdout)
+    if summary_path:
+        run['syscalls'] = count_syscalls(summary_path)
+        os.remove(summary_path)
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark site-metrics.py disk collection on synthetic site trees')
+    parser.add_argument('--sites', type=int, default=20, help='Sites per layout (default: 20)')
+    parser.add_argument('--files', type=int, default=500, help='Files per site (default: 500)')
+    parser.add_argument('--depth', type=int, default=3, help='Directory levels per site (default: 3)')
+    parser.add_argument('--hardlinks', type=int, default=0, help='Extra hard links per site (default: 0)')
+    parser.add_argument('--file-size', type=int, default=4096, help='Bytes per file (default: 4096)')
+    parser.add_argument('--platforms', default=','.join(PLATFORMS), help=f'Layouts to build (default: {",".join(PLATFORMS)})')
+    parser.add_argument('--strategies', default=','.join(STRATEGIES), help=f'Disk usage strategies (default: {",".join(STRATEGIES)})')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per platform and strategy; the median run is reported (default: 3)')
+    parser.add_argument('--strace', action='store_true', help='Count syscalls with strace -f -c')
+    parser.add_argument('--workdir', default=None, help='Where to build the trees (default: system temp dir)')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated trees')
+    parser.add_argument('--exporters', default=EXPORTERS_DIR, help='Directory holding site-metrics.py')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--strategy', default='auto', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+    if args.strace and not shutil.which('strace'):
+        parser.error('--strace needs strace installed')
+
+    args.base = tempfile.mkdtemp(prefix='sqcdy-bench-', dir=args.workdir)
+    report = {
+        'benchmark': 'site-metrics',
+        'python': platform.python_version(),
+        'kernel': platform.release(),
+        'parameters': {key: getattr(args, key) for key in ('sites', 'files', 'depth', 'hardlinks', 'file_size', 'repeat')},
+        'results': [],
+    }
+    try:
+        for layout in args.platforms.split(','):
+            info = generate(os.path.join(args.base, layout), layout, args)
+            for strategy in args.strategies.split(','):
+                runs = sorted((run_one(info, strategy, args) for _ in range(args.repeat)),
+                              key=lambda run: run['wall_seconds'])
+                # The median run, with the spread of all runs
+                result = runs[len(runs) // 2]
+                result.update({
+                    'platform': layout,
+                    'strategy': strategy,
+                    'wall_seconds_runs': [run['wall_seconds'] for run in runs],
+                    # Entries in the generated tree, the same for every strategy
+                    'tree_inodes': info['tree']['files'] + info['tree']['dirs'] + info['tree']['hardlinks'],
+                    'tree': info['tree'],
+                })
+                report['results'].append(result)
+                print(f"{layout}/{strategy}: {result['wall_seconds']:.3f}s", file=sys.stderr)
+    finally:
+        if args.keep:
+            print(f"Trees kept in {args.base}", file=sys.stderr)
+        else:
+            shutil.rmtree(args.base, ignore_errors=True)
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
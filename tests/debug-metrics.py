@@ -31,23 +31,23 @@ if 'composedstaging.squarecandy.site' in log_files_dict:
     metrics = analyzer.analyze_site_logs('composedstaging.squarecandy.site', 
                                          log_files_dict['composedstaging.squarecandy.site'])
     
-    print(f"\nRequests: {metrics['requests_total']}")
-    print(f"Bytes: {metrics['bytes_total']}")
+    print(f"\nRequests: {metrics.requests}")
+    print(f"Bytes: {metrics.bytes}")
     
-    print(f"\nTop IPs ({len(metrics['top_ips'])} unique):")
-    for ip, count in metrics['top_ips'].most_common(5):
+    print(f"\nTop IPs ({len(metrics.ips)} unique):")
+    for ip, count in metrics.top_ips(5):
         print(f"  {ip}: {count}")
     
-    print(f"\nTop User Agents ({len(metrics['top_user_agents'])} unique):")
-    for ua, count in metrics['top_user_agents'].most_common(5):
+    print(f"\nTop User Agents ({len(metrics.user_agents)} unique):")
+    for ua, count in metrics.user_agents.most_common(5):
         print(f"  {ua[:80]}: {count}")
     
-    print(f"\nTop URLs ({len(metrics['top_urls'])} unique):")
-    for url, count in metrics['top_urls'].most_common(5):
+    print(f"\nTop URLs ({len(metrics.urls)} unique):")
+    for url, count in metrics.urls.most_common(5):
         print(f"  {url}: {count}")
     
     print(f"\nStatus Codes:")
-    for status, count in sorted(metrics['status_codes'].items()):
+    for status, count in sorted(metrics.status_codes().items()):
         print(f"  {status}: {count}")
 else:
     print("Domain not found!")